@@ -6,6 +6,9 @@ import numpy as np
 import shutil
 
 from cchess_alphazero.config import Config
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+from cchess_alphazero.environment.fast_env import compact_array, compact_to_planes, BOARD_SIZE
+from cchess_alphazero.lib.shm_helper import SharedMemoryPipe, shared_memory
 from cchess_alphazero.lib.model_helper import load_best_model_weight, need_to_reload_best_model_weight
 from cchess_alphazero.lib.web_helper import http_request, download_file
 from time import time
@@ -18,9 +21,12 @@ class CChessModelAPI:
     def __init__(self, config: Config, agent_model):  
         self.agent_model = agent_model  # CChessModel
         self.pipes = []     # use for communication between processes/threads
+        self.shared = {}    # pipe -> SharedMemoryPipe, for the pipes using shared memory
         self.config = config
         self.need_reload = True
         self.done = False
+        self.digest_value = None    # e.g. a Manager Value, kept to the digest of the loaded weights for other processes
+        self.reset_batch_stats()
 
     def start(self, need_reload=True):
         self.need_reload = need_reload
@@ -32,46 +38,143 @@ class CChessModelAPI:
         me, you = Pipe()
         self.pipes.append(me)
         self.need_reload = need_reload
+        if self.config.play.transport == 'shm':
+            if shared_memory is None:
+                raise RuntimeError('transport shm needs multiprocessing.shared_memory (python 3.8+)')
+            slots = self.config.play.shm_slots
+            # 14 planes per position
+            compact_size = self.agent_model.model.input_shape[1] // 14 * BOARD_SIZE
+            labels_n = len(ActionLabelsRed)
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=SharedMemoryPipe.block_size(slots, compact_size, labels_n))
+            self.shared[me] = SharedMemoryPipe(me, shm, slots, compact_size, labels_n)
+            return SharedMemoryPipe(you, shm, slots, compact_size, labels_n)
+        elif self.config.play.transport != 'pipe':
+            raise RuntimeError('unknown transport: %s' % (self.config.play.transport))
         return you
 
     def predict_batch_worker(self):
         if self.config.internet.distributed and self.need_reload:
             self.try_reload_model_from_internet()
         last_model_check_time = time()
+        last_stats_time = time()
+        pc = self.config.play
+        batch_target = pc.batch_target
+        if batch_target > pc.batch_max:
+            # receive_requests never reads more than batch_max planes, a larger target is never reached
+            logger.warning(f"batch_target = {pc.batch_target} is above batch_max = {pc.batch_max}, use {pc.batch_max}")
+            batch_target = pc.batch_max
         while not self.done:
             if last_model_check_time + 600 < time() and self.need_reload:
                 self.try_reload_model()
                 last_model_check_time = time()
-            ready = connection.wait(self.pipes, timeout=0.001)
+            if pc.batch_stats_interval and last_stats_time + pc.batch_stats_interval < time():
+                self.log_batch_stats()
+                last_stats_time = time()
+            # block until the first request, the timeout is only for checking self.done
+            ready = connection.wait(self.pipes, timeout=0.1)
             if not ready:
                 continue
+            # coalesce requests from all pipes until the target size or the deadline
+            first_time = time()
+            deadline = first_time + pc.batch_max_wait_us / 1e6
             data, result_pipes, data_len = [], [], []
-            for pipe in ready:
-                while pipe.poll():
-                    try:
-                        tmp = pipe.recv()
-                    except EOFError as e:
-                        logger.error(f"EOF error: {e}")
-                        pipe.close()
-                    else:
-                        data.extend(tmp)
-                        data_len.append(len(tmp))
-                        result_pipes.append(pipe)
+            n = 0
+            while True:
+                n += self.receive_requests(ready, data, result_pipes, data_len, pc.batch_max - n)
+                if n >= batch_target:
+                    break
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                ready = connection.wait(self.pipes, timeout=remaining)
+                if not ready:
+                    break
             if not data:
                 continue
-            data = np.asarray(data, dtype=np.float32)
+            data = compact_to_planes(np.concatenate(data) if len(data) > 1 else data[0])
+            self.record_batch(n, time() - first_time)
+            policy_ary, value_ary = [], []
             with self.agent_model.graph.as_default():
-                policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
-            buf = []
-            k, i = 0, 0
-            for p, v in zip(policy_ary, value_ary):
-                buf.append((p, float(v)))
-                k += 1
-                if k >= data_len[i]:
-                    result_pipes[i].send(buf)
-                    buf = []
-                    k = 0
-                    i += 1
+                for i in range(0, n, pc.batch_max):
+                    p, v = self.agent_model.model.predict_on_batch(data[i:i + pc.batch_max])
+                    policy_ary.append(p)
+                    value_ary.append(v)
+            policy_ary = np.concatenate(policy_ary) if len(policy_ary) > 1 else policy_ary[0]
+            value_ary = (np.concatenate(value_ary) if len(value_ary) > 1 else value_ary[0]).reshape(-1)
+            k = 0
+            for (pipe, tmp), l in zip(result_pipes, data_len):
+                if pipe.closed:
+                    pass    # the player went away after sending
+                elif pipe in self.shared:
+                    shared = self.shared[pipe]
+                    shared.policy[tmp] = policy_ary[k:k + l]
+                    shared.value[tmp] = value_ary[k:k + l]
+                    pipe.send(tmp)
+                else:
+                    pipe.send([(p, float(v)) for p, v in zip(policy_ary[k:k + l], value_ary[k:k + l])])
+                k += l
+
+    def receive_requests(self, ready, data, result_pipes, data_len, limit):
+        '''
+        read the pending requests of the ready pipes, stop after `limit` planes.
+        Return the number of planes read.
+        '''
+        n = 0
+        for pipe in ready:
+            while n < limit and pipe.poll():
+                try:
+                    tmp = pipe.recv()
+                except EOFError as e:
+                    logger.error(f"EOF error: {e}")
+                    shared = self.shared.pop(pipe, None)
+                    if shared is not None:
+                        shared.shm.unlink()
+                        shared.close()
+                    else:
+                        pipe.close()
+                    self.pipes.remove(pipe)
+                    break
+                else:
+                    # compact planes, see fast_env.state_to_compact
+                    if pipe in self.shared:
+                        # slot indices, the planes are in shared memory
+                        data.append(self.shared[pipe].planes[tmp])
+                    else:
+                        data.append(compact_array(tmp))
+                    data_len.append(len(tmp))
+                    result_pipes.append((pipe, tmp))
+                    n += len(tmp)
+        return n
+
+    def record_batch(self, size, delay):
+        '''
+        `delay` is the time between the first request of the batch and the prediction
+        '''
+        stats = self.batch_stats
+        stats['batches'] += 1
+        stats['planes'] += size
+        stats['delay'] += delay
+        stats['max_delay'] = max(stats['max_delay'], delay)
+        stats['sizes'][min(size.bit_length(), len(stats['sizes']) - 1)] += 1
+
+    def reset_batch_stats(self):
+        self.batch_stats = {
+            'batches': 0,
+            'planes': 0,
+            'delay': 0,         # seconds
+            'max_delay': 0,
+            'sizes': [0] * 12,  # sizes[i]: batches of 2^(i-1) ~ 2^i - 1 planes
+        }
+
+    def log_batch_stats(self):
+        stats = self.batch_stats
+        if stats['batches'] > 0:
+            sizes = ', '.join(f"<{1 << i}: {c}" for i, c in enumerate(stats['sizes']) if c)
+            logger.info(f"predict {stats['batches']} batches, mean size = {stats['planes'] / stats['batches']:.1f}, "
+                        f"mean delay = {stats['delay'] / stats['batches'] * 1e6:.0f}us, "
+                        f"max delay = {stats['max_delay'] * 1e6:.0f}us, sizes = {{{sizes}}}")
+        self.reset_batch_stats()
 
     def try_reload_model(self, config_file=None):
         if config_file:
@@ -86,6 +189,11 @@ class CChessModelAPI:
                         load_best_model_weight(self.agent_model)
         except Exception as e:
             logger.error(e)
+        self.publish_digest()
+
+    def publish_digest(self):
+        if self.digest_value is not None and self.digest_value.value != self.agent_model.digest:
+            self.digest_value.value = self.agent_model.digest
 
     def try_reload_model_from_internet(self, config_file=None):
         response = http_request(self.config.internet.get_latest_digest)
@@ -101,6 +209,7 @@ class CChessModelAPI:
                 try:
                     with self.agent_model.graph.as_default():
                         load_best_model_weight(self.agent_model)
+                    self.publish_digest()
                 except ValueError as e:
                     logger.error(f"权重架构不匹配，自动重新加载 {e}")
                     self.try_reload_model(config_file='model_192x10_config.json')
@@ -115,3 +224,7 @@ class CChessModelAPI:
 
     def close(self):
         self.done = True
+        for shared in self.shared.values():
+            # the processes that attached it keep their mapping until they exit
+            shared.shm.unlink()
+        self.shared = {}
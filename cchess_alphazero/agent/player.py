@@ -1,13 +1,18 @@
+import heapq
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
+from multiprocessing import connection, Pipe
 from threading import Lock, Condition
 import concurrent.futures.thread
 
 import numpy as np
 import cchess_alphazero.environment.static_env as senv
+import cchess_alphazero.environment.fast_env as fenv
 from cchess_alphazero.config import Config
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move, Move_2_Idx
+from cchess_alphazero.lib.cache_helper import LRUCache, EvalCache
+from cchess_alphazero.lib.shm_helper import SharedMemoryPipe
 from time import time, sleep
 import gc 
 import sys
@@ -23,6 +28,68 @@ class VisitState:
         self.legal_moves = None             # all leagal moves of this state
         self.waiting = False                # is waiting for NN's predict
         self.w = 0
+        self.noise = None                   # dirichlet noise of the root node
+        self.status = None                  # (game_over, v, final_move, check), set on expansion
+        self.generation = 0                 # last search that went through this node, see NodeTable
+        self.pending = 0                    # simulations through this node not backed up yet
+
+    def expand(self, legal_moves, status=None):
+        self.legal_moves = legal_moves
+        self.status = status
+
+    def push_prior(self, move_lookup):
+        '''
+        push p, the prior probability to the edges, only consider legal moves
+        '''
+        all_p = 0
+        for mov in self.legal_moves:
+            mov_p = self.p[move_lookup[mov]]
+            self.a[mov].p = mov_p
+            all_p += mov_p
+        # rearrange the distribution
+        if all_p == 0:
+            all_p = 1
+        for mov in self.legal_moves:
+            self.a[mov].p /= all_p
+        # release the temp policy
+        self.p = None
+
+    def set_priors(self, prior):
+        '''
+        P(s, a) of the legal moves, in their order, e.g. from the evaluation cache
+        '''
+        for mov, mov_p in zip(self.legal_moves, prior):
+            self.a[mov].p = float(mov_p)
+
+    def add_virtual_loss(self, action, virtual_loss):
+        self.pending += 1
+        action_state = self.a[action]
+        action_state.n += virtual_loss
+        action_state.w -= virtual_loss
+        action_state.q = action_state.w / action_state.n
+
+    def backup(self, action, v, virtual_loss):
+        self.pending -= 1
+        action_state = self.a[action]
+        action_state.n += 1 - virtual_loss
+        action_state.w += v + virtual_loss
+        action_state.q = action_state.w * 1.0 / action_state.n
+
+    def edges(self):
+        '''
+        list of (action, N(s, a), Q(s, a), P(s, a)) for the expanded edges
+        '''
+        return [(mov, a.n, a.q, a.p) for mov, a in self.a.items()]
+
+    def edge_arrays(self):
+        '''
+        N(s, a), Q(s, a), P(s, a) as arrays in the order of legal_moves
+        '''
+        edges = [self.a[mov] for mov in self.legal_moves]
+        n = np.array([a.n for a in edges], dtype=np.float32)
+        q = np.array([a.q for a in edges], dtype=np.float32)
+        p = np.array([a.p for a in edges], dtype=np.float32)
+        return n, q, p
 
 
 class ActionState:
@@ -32,45 +99,467 @@ class ActionState:
         self.q = 0      # Q(s, a) = N / W : action value
         self.p = 0      # P(s, a) : prior probability
 
-class CChessPlayer:
-    def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None, 
-            enable_resign=False, debugging=False, uci=False, use_history=False, side=0):
+
+class ArrayVisitState:
+    '''
+    Same as VisitState, but the statistics of all edges are kept in per-node contiguous arrays
+    indexed by the position of the action in `legal_moves`, instead of one ActionState per action.
+    '''
+    __slots__ = ('sum_n', 'visit', 'p', 'legal_moves', 'waiting', 'w', 'noise', 'status', 'generation',
+                 'pending', 'n', 'q', 'prior', 'edge_w', 'index')
+
+    def __init__(self):
+        self.sum_n = 0                      # visit count
+        self.visit = []                     # thread id that has visited this state
+        self.p = None                       # policy of this state
+        self.legal_moves = None             # all leagal moves of this state
+        self.waiting = False                # is waiting for NN's predict
+        self.w = 0
+        self.noise = None                   # dirichlet noise of the root node
+        self.status = None                  # (game_over, v, final_move, check), set on expansion
+        self.generation = 0                 # last search that went through this node, see NodeTable
+        self.pending = 0                    # simulations through this node not backed up yet
+        self.n = None                       # N(s, a) for a in legal_moves
+        self.edge_w = None                  # W(s, a)
+        self.q = None                       # Q(s, a)
+        self.prior = None                   # P(s, a)
+        self.index = None                   # action -> its position in legal_moves
+
+    def expand(self, legal_moves, status=None):
+        self.legal_moves = legal_moves
+        self.status = status
+        self.index = {mov: i for i, mov in enumerate(legal_moves)}
+        k = len(legal_moves)
+        self.n = np.zeros(k, dtype=np.float32)
+        self.edge_w = np.zeros(k, dtype=np.float32)
+        self.q = np.zeros(k, dtype=np.float32)
+        self.prior = np.zeros(k, dtype=np.float32)
+
+    def push_prior(self, move_lookup):
+        prior = np.asarray(self.p, dtype=np.float32)[[move_lookup[mov] for mov in self.legal_moves]]
+        all_p = prior.sum()
+        if all_p == 0:
+            all_p = 1
+        self.prior = prior / all_p
+        self.p = None
+
+    def set_priors(self, prior):
+        self.prior = np.array(prior, dtype=np.float32)
+
+    def add_virtual_loss(self, action, virtual_loss):
+        self.pending += 1
+        i = self.index[action]
+        self.n[i] += virtual_loss
+        self.edge_w[i] -= virtual_loss
+        self.q[i] = self.edge_w[i] / self.n[i]
+
+    def backup(self, action, v, virtual_loss):
+        self.pending -= 1
+        i = self.index[action]
+        self.n[i] += 1 - virtual_loss
+        self.edge_w[i] += v + virtual_loss
+        self.q[i] = self.edge_w[i] / self.n[i]
+
+    def edges(self):
+        if self.legal_moves is None:
+            return []
+        return list(zip(self.legal_moves, self.n.tolist(), self.q.tolist(), self.prior.tolist()))
+
+    def edge_arrays(self):
+        return self.n, self.q, self.prior
+
+
+class StripedLock:
+    '''
+    A fixed pool of locks shared by the nodes: the lock of a key is stripes[hash(key) % n].
+    Only correct where at most one node lock is held at a time, as in CChessPlayer;
+    NodeTable.evict only tries the locks of other nodes without waiting.
+    '''
+    def __init__(self, n=1024):
+        self.stripes = [Lock() for _ in range(n)]
+
+    def __getitem__(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+
+class NodeTable(dict):
+    '''
+    The search tree: zobrist key -> node, missing nodes are created like in a defaultdict.
+
+    It holds at most `capacity` nodes (0 for no limit). When an insertion goes over it, the
+    nodes of the oldest searches, and among them the least visited ones, are evicted until
+    the table is back to 90% of its capacity. The root, the nodes waiting for a prediction and
+    the nodes on the path of a simulation not backed up yet (node.pending) are never evicted.
+    A node is checked and evicted under its lock in `locks`, the one the players take to
+    select through it. An evicted node is only forgotten: its parent keeps the edge statistics,
+    and the node is expanded and evaluated again if a simulation comes back to it.
+    `on_evict(key)` is called for every evicted node, under its lock.
+    '''
+    def __init__(self, factory, capacity=0):
+        super().__init__()
+        self.factory = factory
+        self.capacity = capacity
+        self.generation = 0     # incremented on every search, see new_search
+        self.root = None
+        self.evicted = 0
+        self.lock = Lock()      # one eviction at a time
+        self.locks = StripedLock()
+        self.on_evict = None
+
+    def new_node(self):
+        node = self.factory()
+        node.generation = self.generation
+        return node
+
+    def new_search(self, root):
+        self.generation += 1
+        self.root = root
+
+    def __missing__(self, key):
+        node = self.new_node()
+        self[key] = node
+        return node
+
+    def __setitem__(self, key, node):
+        super().__setitem__(key, node)
+        if 0 < self.capacity < len(self):
+            self.evict(key)
+
+    def evictable(self, key, node):
+        return not node.waiting and node.pending == 0 and key != self.root
+
+    def evict(self, keep=None):
+        if not self.lock.acquire(False):
+            return      # another thread is evicting
+        try:
+            target = len(self) - self.capacity * 9 // 10
+            candidates = [(node.generation, node.sum_n, key) for key, node in list(self.items())
+                          if key != keep and self.evictable(key, node)]
+            for _, _, key in heapq.nsmallest(target, candidates):
+                lock = self.locks[key]
+                if not lock.acquire(False):
+                    continue    # in use, maybe by the caller
+                try:
+                    node = self.get(key)
+                    if node is not None and self.evictable(key, node):
+                        self.pop(key)
+                        self.evicted += 1
+                        if self.on_evict is not None:
+                            self.on_evict(key)
+                finally:
+                    lock.release()
+        finally:
+            self.lock.release()
+
+
+def new_search_tree(config: Config):
+    '''
+    create an empty search tree whose nodes use the backend chosen by `config.play.tree_backend`
+    '''
+    if config.play.tree_backend == 'array':
+        return NodeTable(ArrayVisitState, config.play.max_tree_nodes)
+    elif config.play.tree_backend == 'dict':
+        return NodeTable(VisitState, config.play.max_tree_nodes)
+    else:
+        raise RuntimeError('unknown tree_backend: %s' % (config.play.tree_backend))
+
+_status_cache = None
+
+def get_status_cache(capacity):
+    '''
+    the process wide cache of position status, keyed by zobrist key.
+    The status only depends on the position, so it is shared by all players and search trees.
+    '''
+    global _status_cache
+    if _status_cache is None or _status_cache.capacity != capacity:
+        _status_cache = LRUCache(capacity)
+    return _status_cache
+
+def new_eval_cache(config: Config, digest=None):
+    '''
+    an evaluation cache for the players of the model whose digest is given,
+    None when `config.play.eval_cache_size` is 0
+    '''
+    if config.play.eval_cache_size <= 0:
+        return None
+    cache = EvalCache(config.play.eval_cache_size)
+    cache.check_model(digest)
+    return cache
+
+class TreeSearch:
+    '''
+    The parts of the MCTS player that do not depend on how simulations are run:
+    the search tree, PUCT selection, the input planes of a leaf and the policy of the root
+    '''
+    def __init__(self, config: Config, search_tree=None, play_config=None, enable_resign=False,
+            debugging=False, use_history=False, side=0, eval_cache=None):
         self.config = config
         self.play_config = play_config or self.config.play
         self.labels_n = len(ActionLabelsRed)
         self.labels = ActionLabelsRed
-        self.move_lookup = {move: i for move, i in zip(self.labels, range(self.labels_n))}
-        self.pipe = pipes                   # pipes that used to communicate with CChessModelAPI thread
-        self.node_lock = defaultdict(Lock)  # key: state key, value: Lock of that state
+        self.move_lookup = Move_2_Idx
         self.use_history = use_history
         self.increase_temp = False
+        self.status_cache = get_status_cache(self.play_config.status_cache_size)
+        self.eval_cache = eval_cache        # cache_helper.EvalCache of the network evaluations, or None
 
         if search_tree is None:
-            self.tree = defaultdict(VisitState)  # key: state key, value: VisitState
+            self.tree = new_search_tree(config)  # key: zobrist key, value: VisitState / ArrayVisitState
         else:
             self.tree = search_tree
+        self.tree.on_evict = self.forget
 
-        self.root_state = None
+        self.root_key = None
+        self.root_hist_key = None       # key of the history plane of the root when it comes from outside the tree
 
         self.enable_resign = enable_resign
         self.debugging = debugging
 
         self.search_results = {}        # for debug
         self.debug = {}
+        self.history_states = {}        # key: zobrist key, value: compact planes, only kept when use_history
         self.side = side
+        self.no_act = None
+
+    def position_status(self, pos):
+        '''
+        (game_over, v, final_move, check) of the position, memoized by its zobrist key
+        '''
+        status = self.status_cache.get(pos.key)
+        if status is None:
+            status = pos.done(need_check=True)
+            self.status_cache.put(pos.key, status)
+        return status
+
+    def forget(self, key):
+        '''
+        drop what is kept beside the tree for an evicted node
+        '''
+        self.history_states.pop(key, None)
+        self.debug.pop(key, None)
+
+    def reroot(self, pos):
+        '''
+        make pos the root of the tree: keep the nodes reachable from it through visited edges
+        and free all the others. Nodes still waiting for a prediction are dropped, the
+        prediction will not come back to this tree. Returns the number of nodes kept.
+        '''
+        tree = self.tree
+        node = tree.get(pos.key)
+        if node is None or node.waiting:
+            tree.clear()
+            self.history_states.clear()
+            self.debug.clear()
+            return 0
+        kept = {pos.key: node}
+        stack = [pos.copy()]
+        while stack:
+            pos = stack.pop()
+            for mov, n, _, _ in tree[pos.key].edges():
+                if n <= 0:
+                    continue
+                pos.make(mov)
+                child = tree.get(pos.key)
+                if child is not None and not child.waiting and pos.key not in kept:
+                    kept[pos.key] = child
+                    stack.append(pos.copy())
+                pos.unmake()
+        tree.clear()
+        tree.update(kept)
+        self.history_states = {k: v for k, v in self.history_states.items() if k in kept}
+        self.debug = {k: v for k, v in self.debug.items() if k in kept}
+        return len(kept)
+
+    def leaf_planes(self, pos, history, real_hist=None):
+        '''
+        the compact planes (fenv.state_to_compact) of the position to evaluate
+        '''
+        state_planes = pos.compact()
+        if self.use_history:
+            if real_hist:
+                # logger.debug(f"real history = {real_hist}")
+                state_planes += fenv.state_to_compact(real_hist[-5]) if len(real_hist) >= 5 else fenv.EMPTY_COMPACT
+            elif len(history) >= 5:
+                # logger.debug(f"history = {history}")
+                state_planes += self.history_states[history[-5]]
+            else:
+                state_planes += fenv.EMPTY_COMPACT
+        return state_planes
+
+    def eval_key(self, history):
+        '''
+        64 bits key of the network input of the leaf at the end of history (see leaf_planes):
+        its zobrist key, mixed with the key of the history plane when use_history
+        '''
+        key = history[-1] & fenv.KEY_MASK
+        if not self.use_history:
+            return key
+        if len(history) >= 5:
+            prev = history[-5]
+        elif len(history) == 1:
+            prev = self.root_hist_key
+        else:
+            prev = None
+        if prev is None:
+            return key
+        return key ^ (((prev & fenv.KEY_MASK) * 0x9E3779B97F4A7C15) & fenv.KEY_MASK)
+
+    def cached_eval(self, node, history):
+        '''
+        set the priors of the new node from the evaluation cache, return its value or None on a miss
+        '''
+        if self.eval_cache is None:
+            return None
+        entry = self.eval_cache.get(self.eval_key(history))
+        if entry is None or len(entry[0]) != len(node.legal_moves):
+            return None
+        prior, v = entry
+        node.set_priors(prior)
+        if self.debugging:
+            self.debug[history[-1]] = (None, v)
+        return v
+
+    def store_eval(self, eval_key, node, v):
+        '''
+        cache the evaluation of a node whose priors were just pushed
+        '''
+        self.eval_cache.put(eval_key, node.edge_arrays()[2], v)
+
+    def select_action_q_and_u(self, key, is_root_node, node=None) -> str:
+        '''
+        Select an action with highest Q(s,a) + U(s,a)
+        '''
+        is_root_node = self.root_key == key
+        # logger.debug(f"select_action_q_and_u for {key}, root = {is_root_node}")
+        if node is None:
+            node = self.tree[key]
+        node.generation = self.tree.generation
+        legal_moves = node.legal_moves
+
+        # push p, the prior probability to the edge (node.p), only consider legal moves
+        if node.p is not None:
+            node.push_prior(self.move_lookup)
+
+        # sqrt of sum(N(s, b); for all b)
+        xx_ = np.sqrt(node.sum_n + 1)  
+
+        e = self.play_config.noise_eps
+        c_puct = self.play_config.c_puct
+        dir_alpha = self.play_config.dirichlet_alpha
+
+        n, q, p_ = node.edge_arrays()
+        if is_root_node and e > 0:
+            # sample the noise once per root, not once per move and simulation
+            if node.noise is None:
+                node.noise = np.random.dirichlet(dir_alpha * np.ones(len(legal_moves)))
+            p_ = (1 - e) * p_ + e * node.noise
+        # Q + U
+        scores = q + c_puct * p_ * xx_ / (1 + n)
+
+        if is_root_node and self.no_act:
+            allowed = np.array([mov not in self.no_act for mov in legal_moves])
+            if not allowed.any():
+                logger.error(f"Best action is None, legal_moves = {legal_moves}, no_act = {self.no_act}")
+                return None
+            scores[~allowed] = -np.inf
+        else:
+            allowed = True
+
+        win = np.flatnonzero(allowed & (q > (1 - 1e-7)))
+        if len(win) > 0:
+            return legal_moves[win[0]]
+        # the last one wins among equal scores
+        best = len(scores) - 1 - int(np.argmax(scores[::-1]))
+        # if is_root_node:
+        #     logger.debug(f"selected action = {legal_moves[best]}, with U + Q = {scores[best]}")
+        return legal_moves[best]
+
+    def calc_policy(self, state, turns, no_act) -> np.ndarray:
+        '''
+        calculate π(a|s0) according to the visit count
+        '''
+        node = self.tree[fenv.state_key(state)]
+        policy = np.zeros(self.labels_n)
+        max_q_value = -100
+        debug_result = {}
+
+        for mov, n, q, p in node.edges():
+            policy[self.move_lookup[mov]] = n
+            if no_act and mov in no_act:
+                policy[self.move_lookup[mov]] = 0
+                continue
+            if self.debugging:
+                debug_result[mov] = (n, q, p)
+            if q > max_q_value:
+                max_q_value = q
+
+        if max_q_value < self.play_config.resign_threshold and self.enable_resign and turns > self.play_config.min_resign_turn:
+            return policy, True
+
+        if self.debugging:
+            temp = sorted(range(len(policy)), key=lambda k: policy[k], reverse=True)
+            for i in range(5):
+                index = temp[i]
+                mov = ActionLabelsRed[index]
+                if mov in debug_result:
+                    self.search_results[mov] = debug_result[mov]
+
+        policy /= np.sum(policy)
+        return policy, False
+
+    def visit_counts(self, state, no_act=None):
+        '''
+        the sparse visit distribution of the root, [[index in ActionLabelsRed, N(s, a)], ...]
+        for the searched moves that are allowed
+        '''
+        node = self.tree[fenv.state_key(state)]
+        visits = []
+        for mov, n, _, _ in node.edges():
+            if n > 0 and not (no_act and mov in no_act):
+                visits.append([self.move_lookup[mov], int(n)])
+        return visits
+
+    def apply_temperature(self, policy, turn) -> np.ndarray:
+        if turn < 30 and self.play_config.tau_decay_rate != 0:
+            tau = tau = np.power(self.play_config.tau_decay_rate, turn + 1)
+        else:
+            tau = 0
+        if tau < 0.1 or (turn >= 4 and self.config.opts.evaluate):
+             tau = 0
+        if self.increase_temp and not self.config.opts.evaluate:
+            tau = 0.5
+        if tau == 0:
+            action = np.argmax(policy)
+            ret = np.zeros(self.labels_n)
+            ret[action] = 1.0
+            return ret
+        else:
+            ret = np.power(policy, 1 / tau)
+            ret /= np.sum(ret)
+            return ret
+
+
+class CChessPlayer(TreeSearch):
+    def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None, 
+            enable_resign=False, debugging=False, uci=False, use_history=False, side=0, eval_cache=None):
+        super().__init__(config, search_tree, play_config, enable_resign, debugging, use_history, side, eval_cache)
+        self.pipe = pipes                   # pipes that used to communicate with CChessModelAPI thread
+        self.shared = isinstance(pipes, SharedMemoryPipe)   # planes are passed in shared memory
+        self.node_lock = self.tree.locks    # key: zobrist key, value: Lock of that state
 
         self.s_lock = Lock()
-        self.run_lock = Lock()
         self.q_lock = Lock()            # queue lock
+        self.q_cond = Condition(self.q_lock)    # notified when the queue grows, a result is back or the job is done
+        self.in_flight = False          # a batch is being predicted, at most one at a time
+        self.wakeup_r, self.wakeup_w = Pipe(duplex=False)   # wakes up the receiver when the job is done
         self.t_lock = Lock()
-        self.buffer_planes = []         # prediction queue
+        self.buffer_planes = []         # prediction queue of compact planes, slot indices when self.shared
         self.buffer_history = []
 
         self.all_done = Lock()
         self.num_task = 0
         self.done_tasks = 0
         self.uci = uci
-        self.no_act = None
 
         self.job_done = False
 
@@ -78,15 +567,27 @@ class CChessPlayer:
         self.executor.submit(self.receiver)
         self.executor.submit(self.sender)
 
+    def stop_communication(self):
+        with self.q_cond:
+            if self.job_done:
+                return
+            self.job_done = True
+            self.q_cond.notify_all()
+        try:
+            self.wakeup_w.send(None)
+        except OSError:
+            pass    # the receiver has already seen job_done and closed its end
+        self.wakeup_w.close()
+
     def close(self, wait=True):
-        self.job_done = True
+        self.stop_communication()
         del self.tree
         gc.collect()
         if self.executor is not None:
             self.executor.shutdown(wait=wait)
 
     def close_and_return_action(self, state, turns, no_act=None):
-        self.job_done = True
+        self.stop_communication()
         if self.executor is not None:
             self.executor.shutdown(wait=False)
             # self.executor = None
@@ -99,8 +600,9 @@ class CChessPlayer:
             for act in no_act:
                 policy[self.move_lookup[act]] = 0
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
-        if state in self.debug:
-            _, value = self.debug[state]
+        key = fenv.state_key(state)
+        if key in self.debug:
+            _, value = self.debug[key]
         else:
             value = 0
         return self.labels[my_action], value, self.done_tasks // 100
@@ -110,52 +612,75 @@ class CChessPlayer:
         send planes to neural network for prediction
         '''
         limit = 256                 # max prediction queue size
-        while not self.job_done:
-            self.run_lock.acquire()
-            with self.q_lock:
+        with self.q_cond:
+            while True:
+                while not self.job_done and (self.in_flight or not self.buffer_history):
+                    self.q_cond.wait()
+                if self.job_done:
+                    break
                 l = min(limit, len(self.buffer_history))
-                if l > 0:
-                    t_data = self.buffer_planes[0:l]
-                    # logger.debug(f"send queue size = {l}")
-                    self.pipe.send(t_data)
-                else:
-                    self.run_lock.release()
-                    sleep(0.001)
+                t_data = self.buffer_planes[0:l]
+                # logger.debug(f"send queue size = {l}")
+                self.in_flight = True
+                self.pipe.send(t_data)
 
     def receiver(self):
         '''
-        receive policy and value from neural network
+        receive policy and value from neural network.
+        The wakeup pipe is closed here on exit, its writing end by stop_communication
         '''
-        while not self.job_done:
-            if self.pipe.poll(0.001):
+        try:
+            while not self.job_done:
+                if self.pipe not in connection.wait([self.pipe, self.wakeup_r]):
+                    continue
                 rets = self.pipe.recv()
-            else:
-                continue
-            k = 0
-            with self.q_lock:
-                for ret in rets:
-                    # logger.debug(f"NN ret, update tree buffer_history = {self.buffer_history}")
-                    self.executor.submit(self.update_tree, ret[0], ret[1], self.buffer_history[k])
-                    # self.update_tree(ret[0], ret[1], self.buffer_history[k])
-                    k = k + 1
-                self.buffer_planes = self.buffer_planes[k:]
-                self.buffer_history = self.buffer_history[k:]
-            self.run_lock.release()
+                if self.shared:
+                    rets = self.read_shared(rets)
+                k = len(rets)
+                with self.q_lock:
+                    histories = self.buffer_history[:k]
+                    self.buffer_planes = self.buffer_planes[k:]
+                    self.buffer_history = self.buffer_history[k:]
+                    self.in_flight = False
+                    self.q_cond.notify()
+                # back up the whole batch here, the next one is already being sent
+                self.backup_batch([(p, v, history) for (p, v), history in zip(rets, histories)])
+        finally:
+            self.wakeup_r.close()
+
+    def read_shared(self, slots):
+        '''
+        copy the policy and value out of the shared memory slots and free them
+        '''
+        policy = self.pipe.policy[slots]
+        value = self.pipe.value[slots].tolist()
+        self.pipe.release(slots)
+        return list(zip(policy, value))
 
     def action(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False) -> str:
         self.all_done.acquire(True)
-        self.root_state = state
+        key = fenv.state_key(state)
+        self.root_key = key
+        root = fenv.Position(state, key)
+        if self.play_config.tree_reuse:
+            self.reroot(root)
+        self.tree.new_search(key)
+        if self.use_history:
+            self.history_states[key] = fenv.state_to_compact(state)
         self.no_act = no_act
         self.increase_temp = increase_temp
         if hist and len(hist) >= 5:
             hist = hist[-5:]
+        self.root_hist_key = fenv.state_key(hist[-5]) if hist and len(hist) >= 5 else None
         done = 0
-        if state in self.tree:
-            done = self.tree[state].sum_n
+        if key in self.tree:
+            done = self.tree[key].sum_n
         if no_act or increase_temp or done == self.play_config.simulation_num_per_move:
             # logger.info(f"no_act = {no_act}, increase_temp = {increase_temp}")
             done = 0
         self.done_tasks = done
+        if key in self.tree:
+            self.tree[key].noise = None
         self.num_task = self.play_config.simulation_num_per_move - done
         if depth:
             self.num_task = depth - done if depth > done else 0
@@ -175,12 +700,12 @@ class CChessPlayer:
                 self.done_tasks += self.num_task
                 # logger.debug(f"iter = {iter}, num_task = {self.num_task}")
                 for i in range(self.num_task):
-                    self.executor.submit(self.MCTS_search, state, [state], True, hist)
+                    self.executor.submit(self.MCTS_search, root.copy(), [key], True, hist)
                 self.all_done.acquire(True)
                 if self.uci and depth != self.done_tasks // 100:
                     # info depth xx pv xxx
                     depth = self.done_tasks // 100
-                    _, value = self.debug[state]
+                    _, value = self.debug[key]
                     self.print_depth_info(state, turns, start_time, value, no_act)
         self.all_done.release()
 
@@ -195,217 +720,156 @@ class CChessPlayer:
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
         return self.labels[my_action], list(policy)
 
-    def MCTS_search(self, state, history=[], is_root_node=False, real_hist=None) -> float:
+    def MCTS_search(self, pos, history=[], is_root_node=False, real_hist=None) -> float:
         """
         Monte Carlo Tree Search
+
+        `pos` is a fenv.Position owned by this simulation, it is moved in place down the tree.
+        The tree, the locks and the loop detection use its zobrist key,
+        `history` is [key, action, key, action, ..., key]
         """
         while True:
-            # logger.debug(f"start MCTS, state = {state}, history = {history}")
-            game_over, v, _ = senv.done(state)
+            key = pos.key
+            # logger.debug(f"start MCTS, state = {pos.state()}, history = {history}")
+            node = self.tree.get(key)
+            status = node.status if node is not None else None
+            if status is None:
+                status = self.position_status(pos)
+            game_over, v, _, _ = status
             if game_over:
                 v = v * 2
-                self.executor.submit(self.update_tree, None, v, history)
+                self.update_tree(None, v, history)
                 break
 
-            with self.node_lock[state]:
-                if state not in self.tree:
-                    # Expand and Evaluate
-                    self.tree[state].sum_n = 1
-                    self.tree[state].legal_moves = senv.get_legal_moves(state)
-                    self.tree[state].waiting = True
-                    # logger.debug(f"expand_and_evaluate {state}, sum_n = {self.tree[state].sum_n}, history = {history}")
+            leaf_value = None
+            with self.node_lock[key]:
+                node = self.tree.get(key)
+                if node is None:
+                    # Expand and Evaluate, the node is inserted once it is waiting so that it is not evicted
+                    node = self.tree.new_node()
+                    node.sum_n = 1
+                    node.expand(pos.legal_moves(), status)
+                    leaf_value = self.cached_eval(node, history)
+                    if leaf_value is not None:
+                        self.tree[key] = node
+                        break
+                    node.waiting = True
+                    self.tree[key] = node
+                    # logger.debug(f"expand_and_evaluate {state}, sum_n = {node.sum_n}, history = {history}")
                     if is_root_node and real_hist:
-                        self.expand_and_evaluate(state, history, real_hist)
+                        self.expand_and_evaluate(pos, history, real_hist)
                     else:
-                        self.expand_and_evaluate(state, history)
+                        self.expand_and_evaluate(pos, history)
                     break
 
-                if state in history[:-1]: # loop
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            if senv.will_check_or_catch(state, history[i+1]):
-                                self.executor.submit(self.update_tree, None, -1, history)
-                            elif senv.be_catched(state, history[i+1]):
-                                self.executor.submit(self.update_tree, None, 1, history)
+                if key in history[:-1]: # loop
+                    for i in range(0, len(history) - 1, 2):
+                        if history[i] == key:
+                            if pos.will_check_or_catch(history[i+1]):
+                                leaf_value = -1
+                            elif pos.be_catched(history[i+1]):
+                                leaf_value = 1
                             else:
                                 # logger.debug(f"loop -> loss, state = {state}, history = {history[:-1]}")
-                                self.executor.submit(self.update_tree, None, 0, history)
+                                leaf_value = 0
                             break
                     break
 
                 # Select
-                node = self.tree[state]
                 if node.waiting:
-                    node.visit.append(history)
+                    node.visit.append((pos, history))
                     # logger.debug(f"wait for prediction state = {state}")
                     break
 
-                sel_action = self.select_action_q_and_u(state, is_root_node)
+                sel_action = self.select_action_q_and_u(key, is_root_node, node)
 
                 virtual_loss = self.config.play.virtual_loss
-                self.tree[state].sum_n += 1
+                node.sum_n += 1
                 # logger.debug(f"node = {state}, sum_n = {node.sum_n}")
                 
-                action_state = self.tree[state].a[sel_action]
-                action_state.n += virtual_loss
-                action_state.w -= virtual_loss
-                action_state.q = action_state.w / action_state.n
-
-                # logger.debug(f"apply virtual_loss = {virtual_loss}, as.n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
+                node.add_virtual_loss(sel_action, virtual_loss)
+                if self.use_history:
+                    # under the node lock, so that it is not dropped with an evicted node meanwhile
+                    self.history_states[key] = pos.compact()
                 
                 # if action_state.next is None:
                 history.append(sel_action)
-                state = senv.step(state, sel_action)
-                history.append(state)
+                pos.make(sel_action)
+                history.append(pos.key)
                 # logger.debug(f"step action {sel_action}, next = {action_state.next}")
+        if leaf_value is not None:
+            # a loop or a cached evaluation, out of the node lock: the backup takes the (striped) locks of the path
+            self.update_tree(None, leaf_value, history)
 
-    def select_action_q_and_u(self, state, is_root_node) -> str:
-        '''
-        Select an action with highest Q(s,a) + U(s,a)
-        '''
-        is_root_node = self.root_state == state
-        # logger.debug(f"select_action_q_and_u for {state}, root = {is_root_node}")
-        node = self.tree[state]
-        legal_moves = node.legal_moves
-
-        # push p, the prior probability to the edge (node.p), only consider legal moves
-        if node.p is not None:
-            all_p = 0
-            for mov in legal_moves:
-                mov_p = node.p[self.move_lookup[mov]]
-                node.a[mov].p = mov_p
-                all_p += mov_p
-            # rearrange the distribution
-            if all_p == 0:
-                all_p = 1
-            for mov in legal_moves:
-                node.a[mov].p /= all_p
-            # release the temp policy
-            node.p = None
-
-        # sqrt of sum(N(s, b); for all b)
-        xx_ = np.sqrt(node.sum_n + 1)  
-
-        e = self.play_config.noise_eps
-        c_puct = self.play_config.c_puct
-        dir_alpha = self.play_config.dirichlet_alpha
-
-        best_score = -99999999
-        best_action = None
-        move_counts = len(legal_moves)
-
-        for mov in legal_moves:
-            if is_root_node and self.no_act and mov in self.no_act:
-                # logger.debug(f"mov = {mov}, no_act = {self.no_act}, continue")
-                continue
-            action_state = node.a[mov]
-            p_ = action_state.p
-            if is_root_node:
-                p_ = (1 - e) * p_ + e * np.random.dirichlet(dir_alpha * np.ones(move_counts))[0]
-            # Q + U
-            score = action_state.q + c_puct * p_ * xx_ / (1 + action_state.n)
-            # if score > 0.1 and is_root_node:
-            #     logger.debug(f"U+Q = {score:.2f}, move = {mov}, q = {action_state.q:.2f}")
-            if action_state.q > (1 - 1e-7):
-                best_action = mov
-                break
-            if score >= best_score:
-                best_score = score
-                best_action = mov
-
-        if best_action == None:
-            logger.error(f"Best action is None, legal_moves = {legal_moves}, best_score = {best_score}")
-        # if is_root_node:
-        #     logger.debug(f"selected action = {best_action}, with U + Q = {best_score}")
-        return best_action
-
-    def expand_and_evaluate(self, state, history, real_hist=None):
+    def expand_and_evaluate(self, pos, history, real_hist=None):
         '''
         Evaluate the state, return its policy and value computed by neural network
+        The planes are sent in their compact form (fenv.state_to_compact)
         '''
-        if self.use_history:
-            if real_hist:
-                # logger.debug(f"real history = {real_hist}")
-                state_planes = senv.state_history_to_planes(state, real_hist)
-            else:
-                # logger.debug(f"history = {history}")
-                state_planes = senv.state_history_to_planes(state, history)
-        else:
-            state_planes = senv.state_to_planes(state)
-        with self.q_lock:
+        state_planes = self.leaf_planes(pos, history, real_hist)
+        if self.shared:
+            slot = self.pipe.acquire()
+            self.pipe.planes[slot] = np.frombuffer(state_planes, dtype=np.uint8)
+            state_planes = slot
+        with self.q_cond:
             self.buffer_planes.append(state_planes)
             self.buffer_history.append(history)
+            self.q_cond.notify()
             # logger.debug(f"EAE append buffer_history history = {history}")
 
     def update_tree(self, p, v, history):
-        state = history.pop()
-        z = v
+        self.backup_batch([(p, v, history)])
 
-        if p is not None:
-            with self.node_lock[state]:
-                # logger.debug(f"return from NN state = {state}, v = {v}")
-                node = self.tree[state]
-                node.p = p
-                node.waiting = False
-                if self.debugging:
-                    self.debug[state] = (p, v)
-                for hist in node.visit:
-                    self.executor.submit(self.MCTS_search, state, hist)
-                node.visit = []
+    def backup_batch(self, results):
+        '''
+        results: [(p, v, history), ...], p is None for terminal and repeated positions.
+        Store the predictions, then back up all the values in one pass: the updates are
+        grouped by node so that each node lock is taken once per batch, the root only once.
+        '''
+        resume = []
+        updates = defaultdict(list)     # key -> [(action, v), ...]
+        for p, v, history in results:
+            if p is not None and self.eval_cache is not None:
+                eval_key = self.eval_key(history)
+            key = history.pop()
+            if p is not None:
+                with self.node_lock[key]:
+                    # logger.debug(f"return from NN state = {key}, v = {v}")
+                    node = self.tree[key]
+                    node.p = p
+                    node.push_prior(self.move_lookup)   # keep the priors of the legal moves, not the whole policy
+                    node.waiting = False
+                    if self.eval_cache is not None:
+                        self.store_eval(eval_key, node, v)
+                    if self.debugging:
+                        self.debug[key] = (p, v)
+                    resume += node.visit
+                    node.visit = []
+            while len(history) > 0:
+                action = history.pop()
+                key = history.pop()
+                v = - v
+                updates[key].append((action, v))
 
         virtual_loss = self.config.play.virtual_loss
-        # logger.debug(f"backup from {state}, v = {v}, history = {history}")
-        while len(history) > 0:
-            action = history.pop()
-            state = history.pop()
-            v = - v
-            with self.node_lock[state]:
-                node = self.tree[state]
-                action_state = node.a[action]
-                action_state.n += 1 - virtual_loss
-                action_state.w += v + virtual_loss
-                action_state.q = action_state.w * 1.0 / action_state.n
-                # logger.debug(f"update value: state = {state}, action = {action}, n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
+        for key, edges in updates.items():
+            with self.node_lock[key]:
+                node = self.tree.get(key)
+                if node is None:    # evicted
+                    continue
+                for action, v in edges:
+                    node.backup(action, v, virtual_loss)
+                    # logger.debug(f"update value: state = {state}, action = {action}, n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
+
+        for pos, hist in resume:
+            self.executor.submit(self.MCTS_search, pos, hist)
 
         with self.t_lock:
-            self.num_task -= 1
-            # logger.debug(f"finish 1, remain num task = {self.num_task}")
+            self.num_task -= len(results)
+            # logger.debug(f"finish {len(results)}, remain num task = {self.num_task}")
             if self.num_task <= 0:
                 self.all_done.release()
 
-    def calc_policy(self, state, turns, no_act) -> np.ndarray:
-        '''
-        calculate π(a|s0) according to the visit count
-        '''
-        node = self.tree[state]
-        policy = np.zeros(self.labels_n)
-        max_q_value = -100
-        debug_result = {}
-
-        for mov, action_state in node.a.items():
-            policy[self.move_lookup[mov]] = action_state.n
-            if no_act and mov in no_act:
-                policy[self.move_lookup[mov]] = 0
-                continue
-            if self.debugging:
-                debug_result[mov] = (action_state.n, action_state.q, action_state.p)
-            if action_state.q > max_q_value:
-                max_q_value = action_state.q
-
-        if max_q_value < self.play_config.resign_threshold and self.enable_resign and turns > self.play_config.min_resign_turn:
-            return policy, True
-
-        if self.debugging:
-            temp = sorted(range(len(policy)), key=lambda k: policy[k], reverse=True)
-            for i in range(5):
-                index = temp[i]
-                mov = ActionLabelsRed[index]
-                if mov in debug_result:
-                    self.search_results[mov] = debug_result[mov]
-
-        policy /= np.sum(policy)
-        return policy, False
-
     def print_depth_info(self, state, turns, start_time, value, no_act):
         '''
         info depth xx pv xxx
@@ -414,32 +878,36 @@ class CChessPlayer:
         end_time = time()
         pv = ""
         i = 0
+        pos = fenv.Position(state)
+        key = pos.key
         while i < 20:
-            node = self.tree[state]
+            node = self.tree[key]
             bestmove = None
             root = True
             n = 0
-            if len(node.a) == 0:
+            edges = node.edges()
+            if len(edges) == 0:
                 break
-            for mov, action_state in node.a.items():
-                if action_state.n >= n:
+            for mov, mov_n, _, _ in edges:
+                if mov_n >= n:
                     if root and no_act and mov in no_act:
                         continue
-                    n = action_state.n
+                    n = mov_n
                     bestmove = mov
             if bestmove is None:
-                logger.error(f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(node.a)}")
+                logger.error(f"state = {pos.state()}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(edges)}")
                 break
-            state = senv.step(state, bestmove)
+            pos.make(bestmove)
+            key = pos.key
             root = False
             if turns % 2 == 1:
                 bestmove = flip_move(bestmove)
-            bestmove = senv.to_uci_move(bestmove)
+            bestmove = fenv.to_uci_move(bestmove)
             pv += " " + bestmove
             i += 1
             turns += 1
-        if state in self.debug:
-            _, value = self.debug[state]
+        if key in self.debug:
+            _, value = self.debug[key]
             if turns % 2 != self.side:
                 value = -value
         score = int(value * 1000)
@@ -449,25 +917,164 @@ class CChessPlayer:
         print(output)
         logger.debug(output)
         sys.stdout.flush()
-        
 
-    def apply_temperature(self, policy, turn) -> np.ndarray:
-        if turn < 30 and self.play_config.tau_decay_rate != 0:
-            tau = tau = np.power(self.play_config.tau_decay_rate, turn + 1)
-        else:
-            tau = 0
-        if tau < 0.1 or (turn >= 4 and self.config.opts.evaluate):
-             tau = 0
-        if self.increase_temp and not self.config.opts.evaluate:
-            tau = 0.5
-        if tau == 0:
-            action = np.argmax(policy)
-            ret = np.zeros(self.labels_n)
-            ret[action] = 1.0
-            return ret
-        else:
-            ret = np.power(policy, 1 / tau)
-            ret /= np.sum(ret)
-            return ret
 
+class BatchPlayer(TreeSearch):
+    '''
+    A player without threads nor pipe, for playing many games in one process:
+    the caller starts a search with `start_search`, takes the leaves to evaluate with
+    `collect_leaves`, evaluates the leaves of all its players in one batch and gives the
+    results back with `backup`, until `search_done`; then `choose_action` picks the move.
+    Simulations that reach a node waiting for its prediction continue once it is back,
+    like in CChessPlayer.
+    '''
+    def __init__(self, config: Config, search_tree=None, play_config=None, enable_resign=False,
+            debugging=False, use_history=False, side=0, eval_cache=None):
+        super().__init__(config, search_tree, play_config, enable_resign, debugging, use_history, side, eval_cache)
+        self.root = None
+        self.num_task = 0       # simulations of this move
+        self.started = 0
+        self.done_tasks = 0
+        self.leaves = []        # (compact planes, history) waiting for the neural network
+
+    def start_search(self, state, turns, no_act=None, increase_temp=False):
+        key = fenv.state_key(state)
+        self.root_key = key
+        self.root = fenv.Position(state, key)
+        if self.play_config.tree_reuse:
+            self.reroot(self.root)
+        self.tree.new_search(key)
+        if self.use_history:
+            self.history_states[key] = fenv.state_to_compact(state)
+        self.no_act = no_act
+        self.increase_temp = increase_temp
+        done = 0
+        if key in self.tree:
+            done = self.tree[key].sum_n
+            self.tree[key].noise = None
+        if no_act or increase_temp or done >= self.play_config.simulation_num_per_move:
+            done = 0
+        self.num_task = self.play_config.simulation_num_per_move - done
+        self.started = 0
+        self.done_tasks = 0
+
+    def search_done(self):
+        return self.done_tasks >= self.num_task
+
+    def collect_leaves(self, limit):
+        '''
+        start simulations until `limit` of them are unfinished, return and forget the waiting leaves.
+        Like the search threads of CChessPlayer, a simulation waiting at a node whose prediction
+        is pending counts as unfinished.
+        '''
+        while self.started < self.num_task and self.started - self.done_tasks < limit:
+            self.started += 1
+            self.simulate(self.root.copy(), [self.root_key])
+        leaves = self.leaves
+        self.leaves = []
+        return leaves
+
+    def simulate(self, pos, history):
+        '''
+        the selection of MCTS_search, `pos` and `history` are owned by this simulation
+        '''
+        while True:
+            key = pos.key
+            node = self.tree.get(key)
+            status = node.status if node is not None else None
+            if status is None:
+                status = self.position_status(pos)
+            game_over, v, _, _ = status
+            if game_over:
+                self.backup(None, v * 2, history)
+                return
+
+            if node is None:
+                # Expand, the evaluation is left to the caller unless it is cached
+                node = self.tree.new_node()
+                node.sum_n = 1
+                node.expand(pos.legal_moves(), status)
+                v = self.cached_eval(node, history)
+                if v is not None:
+                    self.tree[key] = node
+                    self.backup(None, v, history)
+                    return
+                node.waiting = True
+                self.tree[key] = node
+                self.leaves.append((self.leaf_planes(pos, history), history))
+                return
+
+            if key in history[:-1]: # loop
+                for i in range(0, len(history) - 1, 2):
+                    if history[i] == key:
+                        if pos.will_check_or_catch(history[i+1]):
+                            self.backup(None, -1, history)
+                        elif pos.be_catched(history[i+1]):
+                            self.backup(None, 1, history)
+                        else:
+                            self.backup(None, 0, history)
+                        return
+
+            if node.waiting:
+                node.visit.append((pos, history))
+                return
+
+            sel_action = self.select_action_q_and_u(key, key == self.root_key, node)
+            if sel_action is None:
+                self.backup(None, 0, history)
+                return
+
+            node.sum_n += 1
+            node.add_virtual_loss(sel_action, self.config.play.virtual_loss)
+            if self.use_history:
+                self.history_states[key] = pos.compact()
+            history.append(sel_action)
+            pos.make(sel_action)
+            history.append(pos.key)
+
+    def backup(self, p, v, history):
+        '''
+        update_tree: store the prediction of the leaf, if any, back up v along history
+        and continue the simulations which were waiting for the leaf
+        '''
+        if p is not None and self.eval_cache is not None:
+            eval_key = self.eval_key(history)
+        key = history.pop()
+        waiting = []
+        if p is not None:
+            node = self.tree[key]
+            node.p = p
+            node.push_prior(self.move_lookup)
+            node.waiting = False
+            if self.eval_cache is not None:
+                self.store_eval(eval_key, node, v)
+            if self.debugging:
+                self.debug[key] = (p, v)
+            waiting = node.visit
+            node.visit = []
+
+        virtual_loss = self.config.play.virtual_loss
+        while len(history) > 0:
+            action = history.pop()
+            key = history.pop()
+            v = - v
+            node = self.tree.get(key)
+            if node is not None:    # else evicted
+                node.backup(action, v, virtual_loss)
+        self.done_tasks += 1
+
+        for pos, hist in waiting:
+            self.simulate(pos, hist)
 
+    def choose_action(self, state, turns, no_act=None):
+        '''
+        the move to play once the search is done, (None, policy) to resign
+        '''
+        policy, resign = self.calc_policy(state, turns, no_act)
+        if resign:
+            return None, list(policy)
+        if no_act is not None:
+            for act in no_act:
+                policy[self.move_lookup[act]] = 0
+        my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
+        return self.labels[my_action], list(policy)
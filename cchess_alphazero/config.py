@@ -49,6 +49,8 @@ class ResourceConfig:
 
         self.play_data_dir = os.path.join(self.data_dir, "play_data")
         self.play_data_filename_tmpl = "play_%s.json"
+        self.play_data_chunk_filename_tmpl = "play_%s.chunk"
+        self.replay_buffer_dir = os.path.join(self.data_dir, "replay_buffer")
         self.self_play_game_idx_file = os.path.join(self.data_dir, "play_data_idx")
         self.play_record_filename_tmpl = "record_%s.qp"
         self.play_record_dir = os.path.join(self.data_dir, "play_record")
@@ -63,6 +65,7 @@ class ResourceConfig:
         self.sl_data_dir = os.path.join(self.data_dir, "sl_data")
         self.sl_data_gameinfo = os.path.join(self.sl_data_dir, "gameinfo.csv")
         self.sl_data_move = os.path.join(self.sl_data_dir, "moves.csv")
+        self.sl_data_cache = os.path.join(self.sl_data_dir, "sl_encoded.npz")
         self.sl_onegreen = os.path.join(self.sl_data_dir, "onegreen.json")
 
         self.font_path = os.path.join(self.project_dir, 'cchess_alphazero', 'play_games', 'PingFang.ttc')
@@ -28,6 +28,8 @@ class PlayDataConfig:
         self.nb_game_in_file = 1
         self.max_file_num = 10
         self.nb_game_save_record = 1
+        self.data_format = 'json'           # 'json' or 'chunk', distributed mode always uploads json
+        self.chunks_per_file = 10           # chunks of nb_game_in_file games per chunk file
 
 
 class PlayConfig:
@@ -44,6 +46,19 @@ class PlayConfig:
         self.max_game_length = 100
         self.share_mtcs_info_in_self_play = False
         self.reset_mtcs_info_per_game = 5
+        self.tree_backend = 'array'         # 'array' (per-node numpy arrays) or 'dict' (VisitState objects)
+        self.tree_reuse = True              # keep the subtree of the new root between searches and free the rest of the tree
+        self.max_tree_nodes = 20000         # nodes of a search tree (~2.5KB each), the least visited of old searches are evicted beyond it, 0: no limit
+        self.status_cache_size = 100000     # positions whose terminal / check status is memoized (LRU)
+        self.eval_cache_size = 100000       # network evaluations (priors, value) memoized by position (LRU), 0: no cache
+        self.eval_cache_shared = False      # one evaluation cache in shared memory for all the self-play processes
+        self.transport = 'pipe'             # 'pipe' (pickled planes) or 'shm' (shared memory, only slot indices are piped)
+        self.shm_slots = 256                # pending predictions per player with transport 'shm'
+        self.batch_target = 5               # CChessModelAPI predicts as soon as this many planes are pending
+        self.batch_max_wait_us = 1000       # ... or when the first pending plane has waited this long
+        self.batch_max = 512                # largest batch given to predict_on_batch
+        self.batch_stats_interval = 600     # seconds between logs of the batch sizes and delays, 0 to disable
+        self.parallel_games = 0             # > 0: self-play runs this many games in one process, their leaves predicted in one batch
         self.enable_resign_rate = 0.1
         self.resign_threshold = -0.92
         self.min_resign_turn = 20
@@ -57,6 +72,18 @@ class TrainerConfig:
         self.batch_size = 2 
         self.epoch_to_checkpoint = 1
         self.dataset_size = 100000
+        self.replay_buffer_size = 0         # samples kept in a memory mapped ring on disk, 0 keeps the dataset in RAM
+        self.replay_window = 0              # trainings a sample of the ring stays eligible for, 0 for no limit
+        self.streaming = False              # train while the play data files are read, instead of loading them first
+        self.shuffle_buffer_size = 10000    # samples shuffled together when streaming
+        self.mirror_augment = False         # mirror a random half of every batch left to right
+        self.dedup = False                  # merge the samples of identical positions into one row weighted by their number
+        self.dedup_cap = 0                  # with dedup, the weight of a position is at most this many samples, 0 for no cap
+        self.continuous = False             # keep running, ingest new play data into the replay buffer and train on it
+        self.train_ratio = 4                # continuous: samples trained per sample ingested
+        self.poll_interval = 60             # continuous: seconds between looks at the play data directory
+        self.min_file_age = 10              # continuous: seconds a play data file must be untouched before it is read
+        self.checkpoint_interval = 1800     # continuous: seconds between saves of the best model
         self.start_total_steps = 0
         self.save_model_steps = 25
         self.load_data_steps = 100
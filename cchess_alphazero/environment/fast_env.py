@@ -0,0 +1,519 @@
+import numpy as np
+import random
+
+from cchess_alphazero.environment.static_env import INIT_STATE, BOARD_HEIGHT, BOARD_WIDTH, evaluate, \
+    state_to_planes, state_history_to_planes, state_to_fen, fen_to_state, flip_fen, fliped_state, render, init, \
+    parse_onegreen_move, parse_ucci_move, to_uci_move, has_attack_chessman
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Action_From, Action_To
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Same API as static_env, but the board is a bytearray of 90 squares (square = y * 9 + x) instead of
+# a 10x9 list of lists, and the moves are generated from precomputed tables.
+#
+# The board is seen from the side to move, like the state: the chessmen of the side to move
+# (upper case in the state, lower case in static_env's board) are stored as their kind (1 ~ 7),
+# the opponent's as kind | OPPONENT. Flipping the board to the other side is a reversed copy
+# plus one translate, both done in C.
+
+EMPTY = 0
+PAWN, CANNON, ROOK, KNIGHT, ELEPHANT, MANDARIN, KING = range(1, 8)
+OPPONENT = 8
+
+BOARD_SIZE = BOARD_HEIGHT * BOARD_WIDTH
+
+# state chars to board codes, upper case is the side to move
+_STATE_CHARS = 'PCRKEMS'
+_CHAR_TO_CODE = bytearray(256)
+_CODE_TO_CHAR = bytearray(b'.' * 256)
+for _kind, _ch in enumerate(_STATE_CHARS, 1):
+    _CHAR_TO_CODE[ord(_ch)] = _kind
+    _CHAR_TO_CODE[ord(_ch.lower())] = _kind | OPPONENT
+    _CODE_TO_CHAR[_kind] = ord(_ch)
+    _CODE_TO_CHAR[_kind | OPPONENT] = ord(_ch.lower())
+_CHAR_TO_CODE = bytes(_CHAR_TO_CODE)
+_CODE_TO_CHAR = bytes(_CODE_TO_CHAR)
+
+# static_env's board letters, used by get_catch_list
+_BOARD_CHARS = '.pcrnbak.PCRNBAK'
+
+# swap the owner of every chessman
+_SWAP_SIDE = bytearray(range(256))
+for _kind in range(1, 8):
+    _SWAP_SIDE[_kind] = _kind | OPPONENT
+    _SWAP_SIDE[_kind | OPPONENT] = _kind
+_SWAP_SIDE = bytes(_SWAP_SIDE)
+
+_EXPAND_DIGITS = {ord(str(i)): '.' * i for i in range(1, 10)}
+
+# Compact input planes: one byte per square, in the order of the squares of the planes (row 0 is the
+# first row of the state), 0 for an empty square, else 1 + the index of the plane of the chessman
+# (Fen_2_Idx, + 7 for the opponent). compact_to_planes expands them to the float32 one-hot planes of
+# state_to_planes / state_history_to_planes.
+_CHAR_TO_PLANE = bytearray(256)
+_CODE_TO_PLANE = bytearray(256)
+for _kind, _ch in enumerate(_STATE_CHARS, 1):
+    _CHAR_TO_PLANE[ord(_ch)] = _kind
+    _CHAR_TO_PLANE[ord(_ch.lower())] = _kind + 7
+    _CODE_TO_PLANE[_kind] = _kind
+    _CODE_TO_PLANE[_kind | OPPONENT] = _kind + 7
+_CHAR_TO_PLANE = bytes(_CHAR_TO_PLANE)
+_CODE_TO_PLANE = bytes(_CODE_TO_PLANE)
+_PLANE_VALUES = np.arange(1, 15, dtype=np.uint8).reshape(14, 1)
+
+
+def _square(x, y):
+    return y * BOARD_WIDTH + x
+
+def _on_board(x, y):
+    return 0 <= x < BOARD_WIDTH and 0 <= y < BOARD_HEIGHT
+
+# MOVE_NAMES[from * 90 + to] = 'x y x_ y_'
+MOVE_NAMES = [f"{f % BOARD_WIDTH}{f // BOARD_WIDTH}{t % BOARD_WIDTH}{t // BOARD_WIDTH}"
+              for f in range(BOARD_SIZE) for t in range(BOARD_SIZE)]
+
+# LABEL_MOVES[index in ActionLabelsRed] = from * 90 + to
+LABEL_MOVES = (Action_From.astype(np.int64) * BOARD_SIZE + Action_To).tolist()
+_LABEL_TO_MOVE = dict(zip(ActionLabelsRed, LABEL_MOVES))
+
+def move_to_int(action):
+    m = _LABEL_TO_MOVE.get(action)
+    if m is None:   # not a move of any chessman
+        m = _square(int(action[0]), int(action[1])) * BOARD_SIZE + _square(int(action[2]), int(action[3]))
+    return m
+
+def _build_tables():
+    rays, knight, elephant, mandarin, king, pawn = [], [], [], [], [], []
+    for sq in range(BOARD_SIZE):
+        x, y = sq % BOARD_WIDTH, sq // BOARD_WIDTH
+        # left, right, down, up; each from near to far
+        rays.append((tuple(_square(i, y) for i in range(x - 1, -1, -1)),
+                     tuple(_square(i, y) for i in range(x + 1, BOARD_WIDTH)),
+                     tuple(_square(x, j) for j in range(y - 1, -1, -1)),
+                     tuple(_square(x, j) for j in range(y + 1, BOARD_HEIGHT))))
+        # (to, leg)
+        knight.append(tuple((_square(x + dx, y + dy), _square(x + int(dx / 2), y + int(dy / 2)))
+                            for dx, dy in [(-1, -2), (1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1)]
+                            if _on_board(x + dx, y + dy)))
+        # (to, eye), never cross the river
+        elephant.append(tuple((_square(x + dx, y + dy), _square(x + dx // 2, y + dy // 2))
+                              for dx, dy in [(-2, -2), (2, -2), (2, 2), (-2, 2)]
+                              if _on_board(x + dx, y + dy) and y + dy <= 4))
+        # stay in the palace
+        mandarin.append(tuple(_square(x + dx, y + dy) for dx, dy in [(-1, -1), (1, -1), (-1, 1), (1, 1)]
+                              if 3 <= x + dx <= 5 and 0 <= y + dy <= 2))
+        king.append(tuple(_square(x + dx, y + dy) for dx, dy in [(0, -1), (1, 0), (0, 1), (-1, 0)]
+                          if 3 <= x + dx <= 5 and 0 <= y + dy <= 2))
+        # move sideways only after crossing the river
+        pawn.append(tuple(_square(x + dx, y + dy) for dx, dy in [(0, 1), (-1, 0), (1, 0)]
+                          if _on_board(x + dx, y + dy) and (dx == 0 or y >= 5)))
+    return tuple(rays), tuple(knight), tuple(elephant), tuple(mandarin), tuple(king), tuple(pawn)
+
+RAYS, KNIGHT_MOVES, ELEPHANT_MOVES, MANDARIN_MOVES, KING_MOVES, PAWN_MOVES = _build_tables()
+
+# Zobrist keys. The low 64 bits are the key of the board seen from the side to move, the high 64 bits
+# the key of the same board seen from the other side, so one xor updates both and the key of the
+# position after a move is the old key with its halves swapped. The seed is fixed so that keys are
+# the same in every process.
+KEY_BITS = 64
+KEY_MASK = (1 << KEY_BITS) - 1
+
+def _build_zobrist():
+    rnd = random.Random(20180806)
+    own = [[rnd.getrandbits(KEY_BITS) for sq in range(BOARD_SIZE)] for code in range(16)]
+    table = [[0] * BOARD_SIZE for code in range(16)]
+    for code in range(1, 16):
+        if code & 7 == 0:
+            continue
+        for sq in range(BOARD_SIZE):
+            table[code][sq] = own[code][sq] | (own[code ^ OPPONENT][BOARD_SIZE - 1 - sq] << KEY_BITS)
+    return table
+
+ZOBRIST = _build_zobrist()
+
+
+def state_to_board(state):
+    rows = state.split(' ')[0].translate(_EXPAND_DIGITS).split('/')
+    return bytearray(''.join(reversed(rows)).encode().translate(_CHAR_TO_CODE))
+
+def board_to_state(board):
+    chars = board.translate(_CODE_TO_CHAR).decode()
+    fen = '/'.join([chars[i:i + BOARD_WIDTH] for i in range(BOARD_SIZE - BOARD_WIDTH, -1, -BOARD_WIDTH)])
+    for i in range(BOARD_WIDTH, 0, -1):
+        fen = fen.replace('.' * i, str(i))
+    return fen
+
+EMPTY_COMPACT = bytes(BOARD_SIZE)
+
+def state_to_compact(state):
+    return state.split(' ')[0].translate(_EXPAND_DIGITS).replace('/', '').encode().translate(_CHAR_TO_PLANE)
+
+def board_to_compact(board):
+    planes = board.translate(_CODE_TO_PLANE)
+    return b''.join([planes[sq:sq + BOARD_WIDTH] for sq in range(BOARD_SIZE - BOARD_WIDTH, -1, -BOARD_WIDTH)])
+
+def state_history_to_compact(state, history):
+    '''
+    compact state_history_to_planes: the state, then the state before the last two moves (or an empty board)
+    '''
+    if history and len(history) >= 5:
+        return state_to_compact(state) + state_to_compact(history[-5])
+    return state_to_compact(state) + EMPTY_COMPACT
+
+def compact_array(compacts):
+    '''
+    a list of compact planes of the same length to an uint8 array of shape (n, length)
+    '''
+    if len(compacts) == 0:
+        return np.zeros((0, BOARD_SIZE), dtype=np.uint8)
+    return np.frombuffer(b''.join(compacts), dtype=np.uint8).reshape(len(compacts), -1)
+
+def compact_to_planes(compacts):
+    '''
+    uint8 array of shape (n, k * 90) to float32 planes of shape (n, k * 14, 10, 9), in one vectorized step
+    '''
+    compacts = np.asarray(compacts, dtype=np.uint8)
+    n = compacts.shape[0]
+    planes = compacts.reshape(n, -1, 1, BOARD_SIZE) == _PLANE_VALUES
+    return planes.astype(np.float32).reshape(n, -1, BOARD_HEIGHT, BOARD_WIDTH)
+
+def mirror_compact(compacts):
+    '''
+    compact planes (n, k * 90) of the positions mirrored left to right
+    '''
+    compacts = np.asarray(compacts, dtype=np.uint8)
+    n = compacts.shape[0]
+    return compacts.reshape(n, -1, BOARD_HEIGHT, BOARD_WIDTH)[..., ::-1].reshape(n, -1)
+
+def board_key(board):
+    key = 0
+    for sq in range(BOARD_SIZE):
+        if board[sq] != EMPTY:
+            key ^= ZOBRIST[board[sq]][sq]
+    return key
+
+def state_key(state):
+    return board_key(state_to_board(state))
+
+def flip_key(key):
+    return (key >> KEY_BITS) | ((key & KEY_MASK) << KEY_BITS)
+
+def flip_board(board):
+    '''
+    the same position seen from the other side
+    '''
+    return bytearray(board[::-1].translate(_SWAP_SIDE))
+
+def gen_moves(board):
+    '''
+    moves of the side to move, as from * 90 + to
+    '''
+    moves = []
+    append = moves.append
+    for sq in range(BOARD_SIZE):
+        piece = board[sq]
+        if piece == EMPTY or piece & OPPONENT:
+            continue
+        base = sq * BOARD_SIZE
+        if piece == ROOK or piece == CANNON:
+            captures = []
+            for k, ray in enumerate(RAYS[sq]):
+                empties = []
+                i = 0
+                n = len(ray)
+                while i < n and board[ray[i]] == EMPTY:
+                    empties.append(ray[i])
+                    i += 1
+                if k == 0 or k == 2:
+                    empties.reverse()
+                for to in empties:
+                    append(base + to)
+                if piece == CANNON:
+                    i += 1
+                    while i < n and board[ray[i]] == EMPTY:
+                        i += 1
+                if i < n and board[ray[i]] & OPPONENT:
+                    captures.append(base + ray[i])
+            moves.extend(captures)
+        elif piece == KNIGHT:
+            for to, leg in KNIGHT_MOVES[sq]:
+                v = board[to]
+                if (v == EMPTY or v & OPPONENT) and board[leg] == EMPTY:
+                    append(base + to)
+        elif piece == PAWN:
+            for to in PAWN_MOVES[sq]:
+                v = board[to]
+                if v == EMPTY or v & OPPONENT:
+                    append(base + to)
+        elif piece == ELEPHANT:
+            for to, eye in ELEPHANT_MOVES[sq]:
+                v = board[to]
+                if (v == EMPTY or v & OPPONENT) and board[eye] == EMPTY:
+                    append(base + to)
+        elif piece == MANDARIN:
+            for to in MANDARIN_MOVES[sq]:
+                v = board[to]
+                if v == EMPTY or v & OPPONENT:
+                    append(base + to)
+        else:
+            flying = False
+            for to in KING_MOVES[sq]:
+                v = board[to]
+                if v == EMPTY or v & OPPONENT:
+                    append(base + to)
+                    # static_env only looks for the face-to-face capture after a legal king move
+                    if not flying:
+                        flying = True
+                        for to_ in RAYS[sq][3]:
+                            if board[to_] != EMPTY:
+                                if board[to_] == KING | OPPONENT:
+                                    append(base + to_)
+                                break
+    return moves
+
+def get_legal_moves(state, board=None):
+    board = board if board is not None else state_to_board(state)
+    return [MOVE_NAMES[m] for m in gen_moves(board)]
+
+def is_attacked(board, sq, other=None):
+    '''
+    whether the opponent could capture the chessman in `sq` if it were his turn,
+    `other` is the flipped board if the caller already has it
+    '''
+    target = BOARD_SIZE - 1 - sq
+    for m in gen_moves(other if other is not None else flip_board(board)):
+        if m % BOARD_SIZE == target:
+            return True
+    return False
+
+def board_done(board, need_check=False, other=None):
+    red_k = board.find(KING)
+    black_k = board.find(KING | OPPONENT)
+    if black_k < 0:
+        return (True, 1, None, False) if need_check else (True, 1, None)
+    if red_k < 0:
+        return (True, -1, None, False) if need_check else (True, -1, None)
+    winner = False
+    v = 0
+    if red_k % BOARD_WIDTH == black_k % BOARD_WIDTH:
+        has_block = False
+        for sq in range(red_k + BOARD_WIDTH, black_k, BOARD_WIDTH):
+            if board[sq] != EMPTY:
+                has_block = True
+                break
+        if not has_block:
+            v = 1
+            winner = True
+    final_move = None
+    check = False
+    if not winner:
+        for m in gen_moves(board):
+            if m % BOARD_SIZE == black_k:
+                winner = True
+                v = 1
+                final_move = MOVE_NAMES[m]
+                break
+    if not winner and need_check:
+        check = is_attacked(board, red_k, other)
+    if need_check:
+        return (winner, v, final_move, check)
+    else:
+        return (winner, v, final_move)
+
+def done(state, turns=-1, need_check=False):
+    return board_done(state_to_board(state), need_check)
+
+def _make_move(board, action):
+    f, t = divmod(move_to_int(action), BOARD_SIZE)
+    if board[f] == EMPTY:
+        raise ValueError(f"No chessman in {action}, state = {board_to_state(board)}")
+    captured = board[t]
+    board[t] = board[f]
+    board[f] = EMPTY
+    return captured
+
+def step(state, action):
+    board = state_to_board(state)
+    _make_move(board, action)
+    return board_to_state(flip_board(board))
+
+def new_step(state, action):
+    board = state_to_board(state)
+    captured = _make_move(board, action)
+    return board_to_state(flip_board(board)), captured == EMPTY
+
+def key_step(state, key, action):
+    '''
+    new_step which also updates the zobrist key of the state incrementally
+    '''
+    board = state_to_board(state)
+    f, t = divmod(move_to_int(action), BOARD_SIZE)
+    piece = board[f]
+    captured = _make_move(board, action)
+    key ^= ZOBRIST[piece][f] ^ ZOBRIST[piece][t] ^ ZOBRIST[captured][t]
+    return board_to_state(flip_board(board)), flip_key(key), captured == EMPTY
+
+def will_check_or_catch(ori_state, action):
+    '''
+    判断走了下一步是否会造成红方将军或捉子
+    '''
+    return Position(ori_state).will_check_or_catch(action)
+
+def get_catch_list(state, moves=None):
+    pos = Position(state)
+    if moves:
+        moves = [move_to_int(mov) for mov in moves]
+    return pos.catch_list(moves)
+
+def be_catched(state, mov):
+    return Position(state).be_catched(mov)
+
+
+class Position:
+    '''
+    A position that is changed in place by make() and restored by unmake().
+
+    It keeps the board seen from both sides: a move writes two squares in each of them and
+    then the two boards swap roles, so the side to move changes without flipping the board.
+    `key` is the zobrist key of the position (see ZOBRIST) and is updated the same way.
+    '''
+    __slots__ = ('board', 'other', 'key', 'stack')
+
+    def __init__(self, state=INIT_STATE, key=None):
+        if state is not None:
+            self.board = state_to_board(state)      # seen from the side to move
+            self.other = flip_board(self.board)     # seen from the other side
+            self.key = key if key is not None else board_key(self.board)
+        self.stack = []                             # (move, captured, key) for unmake
+
+    def copy(self):
+        '''
+        the same position, without the moves that lead to it
+        '''
+        pos = Position(None)
+        pos.board = bytearray(self.board)
+        pos.other = bytearray(self.other)
+        pos.key = self.key
+        return pos
+
+    def state(self):
+        return board_to_state(self.board)
+
+    def compact(self):
+        return board_to_compact(self.board)
+
+    def make(self, action):
+        '''
+        play `action` ('x y x_ y_'), return the captured chessman (EMPTY if none)
+        '''
+        return self.make_move(move_to_int(action))
+
+    def make_move(self, m):
+        f, t = divmod(m, BOARD_SIZE)
+        board, other = self.board, self.other
+        piece = board[f]
+        if piece == EMPTY:
+            raise ValueError(f"No chessman in {MOVE_NAMES[m]}, state = {self.state()}")
+        captured = board[t]
+        board[t] = piece
+        board[f] = EMPTY
+        other[BOARD_SIZE - 1 - t] = piece | OPPONENT
+        other[BOARD_SIZE - 1 - f] = EMPTY
+        self.stack.append((m, captured, self.key))
+        self.key = flip_key(self.key ^ ZOBRIST[piece][f] ^ ZOBRIST[piece][t] ^ ZOBRIST[captured][t])
+        self.board, self.other = other, board
+        return captured
+
+    def unmake(self):
+        m, captured, self.key = self.stack.pop()
+        f, t = divmod(m, BOARD_SIZE)
+        board, other = self.other, self.board
+        piece = board[t]
+        board[f] = piece
+        board[t] = captured
+        other[BOARD_SIZE - 1 - f] = piece | OPPONENT
+        other[BOARD_SIZE - 1 - t] = _SWAP_SIDE[captured]
+        self.board, self.other = board, other
+
+    def gen_moves(self):
+        return gen_moves(self.board)
+
+    def legal_moves(self):
+        return [MOVE_NAMES[m] for m in gen_moves(self.board)]
+
+    def done(self, need_check=False):
+        return board_done(self.board, need_check, self.other)
+
+    def is_attacked(self, sq):
+        return is_attacked(self.board, sq, self.other)
+
+    def be_catched(self, action):
+        return self.is_attacked(move_to_int(action) // BOARD_SIZE)
+
+    def will_check_or_catch(self, action):
+        '''
+        判断走了下一步是否会造成红方将军或捉子
+        '''
+        first_set = self.catch_list()
+        self.make(action)
+        self.pass_move()    # 判断当前state的红方是否会被将/捉
+        red_k = self.board.find(KING | OPPONENT)
+        black_moves = gen_moves(self.board)
+        # permanent check
+        check = False
+        for m in black_moves:
+            if m % BOARD_SIZE == red_k:
+                check = True
+                break
+        # permanent catch
+        if not check:
+            second_set = self.catch_list(black_moves)
+        self.pass_move()
+        self.unmake()
+        if check:
+            return True
+        return second_set - first_set != set() and len(second_set) >= len(first_set)
+
+    def pass_move(self):
+        '''
+        give the move to the other side without moving
+        '''
+        self.board, self.other = self.other, self.board
+        self.key = flip_key(self.key)
+
+    def catch_list(self, moves=None):
+        '''
+        the chessmen of the opponent that the side to move could capture without losing the capturer
+        '''
+        board = self.board
+        if moves is None:
+            moves = gen_moves(board)
+        catch_list = set()
+        for m in moves:
+            f, t = divmod(m, BOARD_SIZE)
+            if board[t] == EMPTY:
+                continue
+            piece, captured = board[f], board[t]
+            # 有吃子, 判断能不能吃回来(防御)
+            self.make_move(m)
+            dest = BOARD_SIZE - 1 - t
+            could_defend = False
+            for nm in gen_moves(self.board):
+                if nm % BOARD_SIZE == dest:
+                    could_defend = True
+                    break
+            self.unmake()
+            if could_defend:
+                continue
+            i, j = divmod(f, BOARD_WIDTH)
+            m_, n_ = divmod(t, BOARD_WIDTH)
+            if piece == PAWN and i <= 4:
+                continue
+            if captured == PAWN | OPPONENT and m_ > 4:
+                continue
+            # 判断是否为兑
+            if piece & 7 == captured & 7:
+                continue
+            catch_list.add((_BOARD_CHARS[piece], i, j, _BOARD_CHARS[captured], m_, n_))
+        return catch_list
@@ -47,7 +47,12 @@ class Color(Enum):
 
 Winner = Enum("Winner", "red black draw")
 
+Flipped_move = {}   # filled once the action labels exist
+
 def flip_move(x):
+    flipped = Flipped_move.get(x)
+    if flipped is not None:
+        return flipped
     new = ''
     new = ''.join([new, str(8 - int(x[0]))])
     new = ''.join([new, str(9 - int(x[1]))])
@@ -134,8 +139,32 @@ def create_action_labels():
 ActionLabelsRed = create_action_labels()
 ActionLabelsBlack = flip_action_labels(ActionLabelsRed)
 
-Unflipped_index = [ActionLabelsRed.index(x) for x in ActionLabelsBlack]
+Flipped_move.update(zip(ActionLabelsRed, ActionLabelsBlack))
+
+# move string -> index in ActionLabelsRed
+Move_2_Idx = {move: i for i, move in enumerate(ActionLabelsRed)}
+
+# index in ActionLabelsRed -> from / to square (y * 9 + x, as in fast_env)
+Action_From = np.array([int(m[1]) * 9 + int(m[0]) for m in ActionLabelsRed], dtype=np.int16)
+Action_To = np.array([int(m[3]) * 9 + int(m[2]) for m in ActionLabelsRed], dtype=np.int16)
+
+# permutation of the policy indexes that flips the board, it is its own inverse
+Unflipped_index = np.array([Move_2_Idx[x] for x in ActionLabelsBlack], dtype=np.int64)
+
+def mirror_move(x):
+    return ''.join([str(8 - int(x[0])), x[1], str(8 - int(x[2])), x[3]])
+
+# permutation of the policy indexes that mirrors the board left to right, its own inverse too
+Mirrored_index = np.array([Move_2_Idx[mirror_move(x)] for x in ActionLabelsRed], dtype=np.int64)
+
+def mirror_policy(pol):
+    return np.asarray(pol)[..., Mirrored_index]
 
 def flip_policy(pol):
-    global Unflipped_index
-    return np.asarray([pol[ind] for ind in Unflipped_index])
+    return np.asarray(pol)[..., Unflipped_index]
+
+def build_policy(action, flip=False):
+    policy = np.zeros(len(ActionLabelsRed))
+    idx = Move_2_Idx[action]
+    policy[Unflipped_index[idx] if flip else idx] = 1
+    return policy
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class LRUCache:
+    '''
+    A bounded, thread safe mapping that drops the least recently used entry when it is full
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.get(key, default)
+            if value is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.capacity:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class EvalCache(LRUCache):
+    '''
+    Network evaluations by position: eval key (see TreeSearch.eval_key) -> (priors of the legal
+    moves in the order of legal_moves, value), shared by the players of a process.
+
+    The entries belong to the weights whose digest (CChessModel.digest) was last given to
+    check_model, which the owner calls when the model may have been reloaded: a new digest
+    drops all the entries, the statistics are kept.
+    '''
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.digest = None
+
+    def check_model(self, digest):
+        if digest == self.digest:
+            return
+        if self.digest is not None:
+            logger.info(f"Model changed, clear the evaluation cache ({self.stats()})")
+        self.digest = digest
+        self.model_changed(digest)
+
+    def model_changed(self, digest):
+        with self.lock:
+            self.data.clear()
+
+    def put(self, key, prior, value):
+        super().put(key, (np.array(prior, dtype=np.float16), value))
+
+    def stats(self):
+        return f"{len(self)} entries, hit rate {self.hit_rate() * 100:.1f}% of {self.hits + self.misses}"
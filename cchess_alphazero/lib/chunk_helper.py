@@ -0,0 +1,336 @@
+'''
+Binary play data: append-only files made of independently compressed chunks of games.
+
+File layout:
+    FILE_MAGIC version
+    chunk*
+
+Chunk layout (little endian):
+    CHUNK_MAGIC n_games raw_size comp_size crc32    -- CHUNK_HEADER
+    zlib(payload)
+
+Payload layout:
+    game table: n_games * (offset, n_moves, flags)  -- GAME_ENTRY, offset into the payload
+    per game:
+        init state          uint16 length + utf-8
+        moves               n_moves * uint16, index in ActionLabelsRed
+        values              n_moves * int8 when all values are -1/0/1, else float32
+        visits (optional)   n_moves * uint16 length, then
+                            sum(length) * uint16 index, sum(length) * uint32 count
+
+A game read back is the same list the json files store:
+    [init_state, [action, value, [[index, count], ...]], ...]
+'''
+import json
+import os
+import socket
+import struct
+import zlib
+from bisect import bisect_right
+from logging import getLogger
+from threading import Lock
+from time import time
+
+import numpy as np
+
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Move_2_Idx
+
+logger = getLogger(__name__)
+
+FILE_MAGIC = b'CCPD'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sB')
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIIII')
+GAME_ENTRY = struct.Struct('<IHB')
+PART_SUFFIX = '.part'
+PART_TIMEOUT = 24 * 3600    # seconds without a write after which any part file counts as abandoned
+
+HAS_VISITS = 1
+FLOAT_VALUES = 2
+
+def split_games(data):
+    '''
+    split a flat json play data list, which holds several games back to back, into games
+    '''
+    games = []
+    for item in data:
+        if isinstance(item, str):
+            games.append([item])
+        elif games:
+            games[-1].append(item)
+    return games
+
+
+def encode_game(game):
+    state = game[0].encode('utf-8')
+    items = game[1:]
+    moves = np.array([Move_2_Idx[item[0]] for item in items], dtype='<u2')
+    values = [item[1] for item in items]
+    flags = 0
+    if all(v in (-1, 0, 1) for v in values):
+        values = np.array(values, dtype=np.int8)
+    else:
+        values = np.array(values, dtype='<f4')
+        flags |= FLOAT_VALUES
+    parts = [struct.pack('<H', len(state)), state, moves.tobytes(), values.tobytes()]
+    if any(len(item) > 2 and item[2] for item in items):
+        flags |= HAS_VISITS
+        visits = [item[2] if len(item) > 2 and item[2] else [] for item in items]
+        lengths = np.array([len(v) for v in visits], dtype='<u2')
+        pairs = np.array([p for v in visits for p in v], dtype=np.int64).reshape(-1, 2)
+        parts += [lengths.tobytes(), pairs[:, 0].astype('<u2').tobytes(), pairs[:, 1].astype('<u4').tobytes()]
+    return b''.join(parts), len(items), flags
+
+
+def decode_game(payload, offset, n_moves, flags):
+    length, = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    state = payload[offset:offset + length].decode('utf-8')
+    offset += length
+    moves = np.frombuffer(payload, dtype='<u2', count=n_moves, offset=offset)
+    offset += n_moves * 2
+    if flags & FLOAT_VALUES:
+        values = np.frombuffer(payload, dtype='<f4', count=n_moves, offset=offset).tolist()
+        offset += n_moves * 4
+    else:
+        values = np.frombuffer(payload, dtype=np.int8, count=n_moves, offset=offset).tolist()
+        offset += n_moves
+    game = [state]
+    if flags & HAS_VISITS:
+        lengths = np.frombuffer(payload, dtype='<u2', count=n_moves, offset=offset)
+        offset += n_moves * 2
+        total = int(lengths.sum())
+        idx = np.frombuffer(payload, dtype='<u2', count=total, offset=offset).tolist()
+        offset += total * 2
+        cnt = np.frombuffer(payload, dtype='<u4', count=total, offset=offset).tolist()
+        start = 0
+        for move, value, n in zip(moves.tolist(), values, lengths.tolist()):
+            visits = [[i, c] for i, c in zip(idx[start:start + n], cnt[start:start + n])]
+            game.append([ActionLabelsRed[move], value, visits])
+            start += n
+    else:
+        for move, value in zip(moves.tolist(), values):
+            game.append([ActionLabelsRed[move], value])
+    return game
+
+
+def encode_chunk(games, level=6):
+    table = []
+    bodies = []
+    offset = GAME_ENTRY.size * len(games)
+    for game in games:
+        body, n_moves, flags = encode_game(game)
+        table.append(GAME_ENTRY.pack(offset, n_moves, flags))
+        bodies.append(body)
+        offset += len(body)
+    payload = b''.join(table + bodies)
+    comp = zlib.compress(payload, level)
+    header = CHUNK_HEADER.pack(CHUNK_MAGIC, len(games), len(payload), len(comp), zlib.crc32(comp))
+    return header + comp
+
+
+def decode_chunk(n_games, payload):
+    games = []
+    for i in range(n_games):
+        offset, n_moves, flags = GAME_ENTRY.unpack_from(payload, i * GAME_ENTRY.size)
+        games.append(decode_game(payload, offset, n_moves, flags))
+    return games
+
+
+def append_games(path, games, level=6):
+    '''
+    append games to path as one chunk, the chunk is written with a single write so that
+    a reader never sees more than a truncated tail, which it ignores
+    '''
+    if not games:
+        return
+    data = encode_chunk(games, level)
+    with open(path, 'ab') as f:
+        if f.tell() == 0:
+            data = FILE_HEADER.pack(FILE_MAGIC, VERSION) + data
+        f.write(data)
+
+
+def part_path(path):
+    '''
+    the file this process writes path into until it is finished: path@host-pid.part
+    '''
+    return f"{path}@{socket.gethostname()}-{os.getpid()}{PART_SUFFIX}"
+
+
+def process_alive(pid):
+    if os.name == 'nt':
+        return True     # os.kill would terminate it, leave it to the timeout
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ChunkWriter:
+    '''
+    Appends chunks to a part file which is renamed once it holds chunks_per_file chunks,
+    so that readers listing the play data directory only ever see finished files
+    '''
+    def __init__(self, chunks_per_file, level=6):
+        self.chunks_per_file = chunks_per_file
+        self.level = level
+        self.path = None
+        self.part = None
+        self.count = 0
+
+    def write(self, path, games):
+        '''
+        path names the file the games go to when no file is open, returns the finished file or None
+        '''
+        if self.path is None:
+            self.path = path
+            self.part = part_path(path)
+        append_games(self.part, games, self.level)
+        self.count += 1
+        if self.count >= self.chunks_per_file:
+            return self.close()
+        return None
+
+    def close(self):
+        path = self.path
+        if path is not None:
+            os.rename(self.part, path)
+        self.path = None
+        self.part = None
+        self.count = 0
+        return path
+
+
+def finish_part_files(directory, timeout=PART_TIMEOUT):
+    '''
+    rename the part files left by writers which did not close: those of the dead processes of
+    this host, and any part file (of another host, or untagged) not written to for timeout
+    seconds. The part files of running writers are left alone.
+    '''
+    host = socket.gethostname()
+    for name in os.listdir(directory):
+        if not name.endswith(PART_SUFFIX):
+            continue
+        path = os.path.join(directory, name)
+        target, _, tag = name[:-len(PART_SUFFIX)].rpartition('@')
+        if not target:
+            target, tag = tag, ''
+        writer_host, _, pid = tag.rpartition('-')
+        try:
+            abandoned = time() - os.path.getmtime(path) > timeout
+            if not abandoned and writer_host == host and pid.isdigit():
+                abandoned = not process_alive(int(pid))
+            if abandoned:
+                os.rename(path, os.path.join(directory, target))
+                logger.info(f"Finish the part file {name} of a writer which did not close")
+        except OSError:
+            pass    # finished by another process meanwhile
+
+
+class ChunkReader:
+    '''
+    Random access to the games of a chunk file, only the chunk holding a game is decompressed
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.lock = Lock()
+        self.chunks = []    # (file offset of the compressed payload, comp_size, n_games, crc32)
+        self.firsts = []    # index of the first game of every chunk
+        self.n_games = 0
+        self.cached = None  # (chunk index, games)
+        self.scan()
+
+    def scan(self):
+        self.f.seek(0, os.SEEK_END)
+        size = self.f.tell()
+        self.f.seek(0)
+        magic, version = FILE_HEADER.unpack(self.f.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC or version > VERSION:
+            raise ValueError(f"{self.path} is not a play data chunk file")
+        pos = FILE_HEADER.size
+        while pos + CHUNK_HEADER.size <= size:
+            self.f.seek(pos)
+            magic, n_games, raw_size, comp_size, crc = CHUNK_HEADER.unpack(self.f.read(CHUNK_HEADER.size))
+            if magic != CHUNK_MAGIC:
+                raise ValueError(f"{self.path} is corrupted at {pos}")
+            data_pos = pos + CHUNK_HEADER.size
+            if data_pos + comp_size > size:
+                logger.debug(f"{self.path} has a truncated chunk at {pos}")
+                break
+            self.chunks.append((data_pos, comp_size, n_games, crc))
+            self.firsts.append(self.n_games)
+            self.n_games += n_games
+            pos = data_pos + comp_size
+
+    def read_chunk(self, i):
+        if self.cached is not None and self.cached[0] == i:
+            return self.cached[1]
+        data_pos, comp_size, n_games, crc = self.chunks[i]
+        with self.lock:
+            self.f.seek(data_pos)
+            comp = self.f.read(comp_size)
+        if zlib.crc32(comp) != crc:
+            raise ValueError(f"{self.path} chunk {i} is corrupted")
+        games = decode_chunk(n_games, zlib.decompress(comp))
+        self.cached = (i, games)
+        return games
+
+    def __len__(self):
+        return self.n_games
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.n_games
+        if not 0 <= idx < self.n_games:
+            raise IndexError(idx)
+        i = bisect_right(self.firsts, idx) - 1
+        return self.read_chunk(i)[idx - self.firsts[i]]
+
+    def __iter__(self):
+        for i in range(len(self.chunks)):
+            yield from self.read_chunk(i)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_games(path):
+    with ChunkReader(path) as reader:
+        return list(reader)
+
+
+def convert_json_files(filenames, path, level=6, remove=False):
+    '''
+    convert json play data files into one chunk file, a chunk per json file,
+    returns the number of games written
+    '''
+    total = 0
+    done = []
+    for filename in filenames:
+        try:
+            with open(filename, 'rt') as f:
+                games = split_games(json.load(f))
+        except Exception as e:
+            logger.error(f"Skip {filename}: {e}")
+            continue
+        append_games(part_path(path), games, level)
+        total += len(games)
+        done.append(filename)
+    if os.path.exists(part_path(path)):
+        os.rename(part_path(path), path)
+    if remove:
+        for filename in done:
+            os.remove(filename)
+    return total
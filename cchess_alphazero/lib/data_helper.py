@@ -5,13 +5,15 @@ from glob import glob
 from logging import getLogger
 
 from cchess_alphazero.config import ResourceConfig
+from cchess_alphazero.lib import chunk_helper
 
 logger = getLogger(__name__)
 
 def get_game_data_filenames(rc: ResourceConfig):
     pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
+    chunk_pattern = os.path.join(rc.play_data_dir, rc.play_data_chunk_filename_tmpl % "*")
     # files = list(sorted(glob(pattern), key=get_key))
-    files = list(sorted(glob(pattern)))
+    files = list(sorted(glob(pattern) + glob(chunk_pattern)))
     return files
 
 def write_game_data_to_file(path, data):
@@ -23,6 +25,33 @@ def read_game_data_from_file(path):
     with open(path, "rt") as f:
         return json.load(f)
 
+
+def read_games_from_file(path):
+    '''
+    list of games, [init_state, [action, value, visits], ...] each, from a json or chunk file
+    '''
+    if path.endswith(".json"):
+        return chunk_helper.split_games(read_game_data_from_file(path))
+    return chunk_helper.read_games(path)
+
+def convert_game_data_files(rc: ResourceConfig, files_per_chunk_file, remove=True):
+    '''
+    convert the json play data files into chunk files of files_per_chunk_file chunks each,
+    a chunk file is named after the last json file it holds so the files keep their order
+    '''
+    pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
+    files = list(sorted(glob(pattern)))
+    prefix, suffix = rc.play_data_filename_tmpl.split("%s")
+    total = 0
+    for i in range(0, len(files), files_per_chunk_file):
+        group = files[i:i + files_per_chunk_file]
+        game_id = os.path.basename(group[-1])[len(prefix):-len(suffix)]
+        path = os.path.join(rc.play_data_dir, rc.play_data_chunk_filename_tmpl % game_id)
+        n = chunk_helper.convert_json_files(group, path, remove=remove)
+        logger.info(f"Convert {len(group)} files ({n} games) to {path}")
+        total += n
+    return total
+
 def get_key(x):
     stat_x = os.stat(x) 
     return stat_x.st_ctime
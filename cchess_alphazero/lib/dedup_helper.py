@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def dedup_samples(states, policies, values, counts=None):
+    '''
+    Merge the rows of identical positions (the same compact row, history included) into one:
+    its policy and value are the averages over its rows weighted by their counts (the number
+    of samples a row stands for, 1 for every row when None), its count is their sum.
+    Returns the new arrays, in the order the positions were first seen, and the counts.
+    '''
+    states = np.asarray(states, dtype=np.uint8)
+    policies = np.asarray(policies, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32)
+    counts = np.ones(len(states), dtype=np.float32) if counts is None else np.asarray(counts, dtype=np.float32)
+    if len(states) == 0:
+        return states, policies, values, counts
+    # every compact row as one fixed width bytes item, the key of its position
+    keys = np.ascontiguousarray(states).view('S%d' % states.shape[1]).reshape(-1)
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique = states[first]
+    count_sum = np.bincount(inverse, weights=counts, minlength=len(unique))
+    # policies are sparse (visit counts or one hot), sum only their non zero entries
+    rows, cols = np.nonzero(policies)
+    policy_sum = np.zeros((len(unique), policies.shape[1]), dtype=np.float32)
+    np.add.at(policy_sum, (inverse[rows], cols), policies[rows, cols] * counts[rows])
+    policy_sum /= count_sum[:, None]
+    value_mean = (np.bincount(inverse, weights=values * counts, minlength=len(unique)) / count_sum).astype(np.float32)
+    # keep the positions in the order they were first seen
+    order = np.argsort(first, kind='stable')
+    return unique[order], policy_sum[order], value_mean[order], count_sum[order].astype(np.float32)
+
+
+def sample_weights(counts, cap=0):
+    '''
+    the training weight of merged rows: their counts, at most cap when cap > 0, scaled to a mean of 1
+    '''
+    weights = np.asarray(counts, dtype=np.float32)
+    if cap > 0:
+        weights = np.minimum(weights, cap)
+    return weights / weights.mean() if len(weights) > 0 else weights
@@ -0,0 +1,155 @@
+import os
+import json
+from logging import getLogger
+
+import numpy as np
+
+import cchess_alphazero.environment.fast_env as fenv
+from cchess_alphazero.lib.stream_helper import mirror_half
+
+logger = getLogger(__name__)
+
+
+class ReplayBuffer:
+    '''
+    Fixed capacity ring of training samples kept in memory mapped .npy files.
+
+    Positions are stored compact (fenv.compact), policies as their policy_entries largest
+    probabilities, and every sample remembers the generation it was added in, so that
+    only the latest `window` generations are sampled. Batches are expanded to planes
+    when they are drawn, the resident memory is the pages the sampler touches.
+    A fixed `holdout` fraction of the rows (chosen by a seeded draw over the row indices)
+    is never sampled for training, validation_batch draws from them.
+    '''
+    def __init__(self, directory, capacity, compact_size, labels_n, window=0, policy_entries=128, holdout=0.02):
+        self.directory = directory
+        self.capacity = capacity
+        self.compact_size = compact_size
+        self.labels_n = labels_n
+        self.window = window
+        self.policy_entries = min(policy_entries, labels_n)
+        self.meta_path = os.path.join(directory, 'replay.json')
+        self.head = 0
+        self.generation = 0
+        self.valid = None
+        self.valid_holdout = None
+        self.holdout = np.random.RandomState(0).random_sample(capacity) < holdout
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        shape = {'capacity': capacity, 'compact_size': compact_size, 'labels_n': labels_n,
+                 'policy_entries': self.policy_entries}
+        mode = 'w+'
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'rt') as f:
+                meta = json.load(f)
+            if all(meta.get(k) == v for k, v in shape.items()):
+                mode = 'r+'
+                self.head = meta['head']
+                self.generation = meta['generation']
+            else:
+                logger.info(f"Replay buffer shape changed, recreate {directory}")
+        self.states = self.open('states', mode, np.uint8, (capacity, compact_size))
+        self.policy_idx = self.open('policy_idx', mode, np.uint16, (capacity, self.policy_entries))
+        self.policy_p = self.open('policy_p', mode, np.float16, (capacity, self.policy_entries))
+        self.values = self.open('values', mode, np.float32, (capacity,))
+        self.generations = self.open('generations', mode, np.int32, (capacity,))
+        if mode == 'w+':
+            self.generations[:] = -1
+            self.flush()
+        logger.info(f"Replay buffer {directory}: {len(self)} samples, generation {self.generation}")
+
+    def open(self, name, mode, dtype, shape):
+        path = os.path.join(self.directory, name + '.npy')
+        return np.lib.format.open_memmap(path, mode=mode, dtype=dtype, shape=shape)
+
+    def add(self, states, policies, values):
+        '''
+        states: compact positions (n, compact_size), policies: dense (n, labels_n), values: (n,)
+        '''
+        n = len(states)
+        if n == 0:
+            return
+        if n > self.capacity:
+            states, policies, values = states[-self.capacity:], policies[-self.capacity:], values[-self.capacity:]
+            n = self.capacity
+        policies = np.asarray(policies, dtype=np.float32)
+        k = self.policy_entries
+        if k < self.labels_n:
+            idx = np.argpartition(-policies, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(k), (n, k))
+        rows = (self.head + np.arange(n)) % self.capacity
+        self.states[rows] = states
+        self.policy_idx[rows] = idx
+        self.policy_p[rows] = np.take_along_axis(policies, idx, axis=1)
+        self.values[rows] = values
+        self.generations[rows] = self.generation
+        self.head = int((self.head + n) % self.capacity)
+        self.valid = None
+        self.valid_holdout = None
+
+    def new_generation(self):
+        self.generation += 1
+        self.valid = None
+        self.valid_holdout = None
+        self.flush()
+
+    def valid_rows(self):
+        '''
+        the rows to train on: in the window and not held out
+        '''
+        if self.valid is None:
+            gens = np.asarray(self.generations)
+            lowest = self.generation - self.window + 1 if self.window > 0 else 0
+            in_window = gens >= max(lowest, 0)     # never written rows have generation -1
+            self.valid = np.flatnonzero(in_window & ~self.holdout)
+            self.valid_holdout = np.flatnonzero(in_window & self.holdout)
+        return self.valid
+
+    def holdout_rows(self):
+        self.valid_rows()
+        return self.valid_holdout
+
+    def __len__(self):
+        return len(self.valid_rows())
+
+    def batch(self, rows, mirror=False):
+        rows = np.sort(rows)
+        n = len(rows)
+        states = self.states[rows]
+        policy = np.zeros((n, self.labels_n), dtype=np.float32)
+        policy[np.arange(n)[:, None], self.policy_idx[rows]] = self.policy_p[rows]
+        policy /= np.maximum(policy.sum(axis=1, keepdims=True), 1e-8)
+        if mirror:
+            states, policy = mirror_half(states, policy)
+        return fenv.compact_to_planes(states), policy, np.array(self.values[rows])
+
+    def sample(self, batch_size, rng=np.random, mirror=False):
+        return self.batch(rng.choice(self.valid_rows(), batch_size), mirror)
+
+    def validation_batch(self, size, rng=np.random):
+        '''
+        up to size held out samples, None when there are none
+        '''
+        rows = self.holdout_rows()
+        if len(rows) == 0:
+            return None
+        if len(rows) > size:
+            rows = rng.choice(rows, size, replace=False)
+        return self.batch(rows)
+
+    def generator(self, batch_size, mirror=False):
+        '''
+        endless batches for Model.fit_generator, with mirror a random half of each batch is mirrored
+        '''
+        while True:
+            planes, policy, value = self.sample(batch_size, mirror=mirror)
+            yield planes, [policy, value]
+
+    def flush(self):
+        for ary in (self.states, self.policy_idx, self.policy_p, self.values, self.generations):
+            ary.flush()
+        meta = {'capacity': self.capacity, 'compact_size': self.compact_size, 'labels_n': self.labels_n,
+                'policy_entries': self.policy_entries, 'head': self.head, 'generation': self.generation}
+        with open(self.meta_path, 'wt') as f:
+            json.dump(meta, f)
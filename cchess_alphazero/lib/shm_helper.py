@@ -0,0 +1,217 @@
+import zlib
+import numpy as np
+from collections import deque
+from threading import Condition
+
+from cchess_alphazero.lib.cache_helper import EvalCache
+
+try:
+    from multiprocessing import shared_memory, resource_tracker     # python 3.8+
+except ImportError:
+    shared_memory = None
+
+
+def _tracker_pid():
+    return getattr(resource_tracker._resource_tracker, '_pid', None)
+
+
+class SharedMemoryPipe:
+    '''
+    One end of the shared memory transport between a player and CChessModelAPI.
+
+    The compact planes (see fast_env.state_to_compact) of up to `slots` pending predictions, their
+    policies and values live in one block of shared memory; the player writes the planes into a free
+    slot and only the slot indices go through the pipe, both ways. Pickling it (e.g. into a Manager
+    list) sends the pipe and the name of the block, which is attached again in the other process.
+    '''
+    def __init__(self, pipe, shm, slots, compact_size, labels_n):
+        self.pipe = pipe
+        self.shm = shm
+        self.slots = slots
+        self.compact_size = compact_size
+        self.labels_n = labels_n
+        self.owner_tracker = _tracker_pid()     # resource tracker of the process that created the block
+        self._map()
+
+    @staticmethod
+    def block_size(slots, compact_size, labels_n):
+        return slots * ((labels_n + 1) * 4 + compact_size)
+
+    def _map(self):
+        # float32 policies and values first, then the uint8 planes
+        policy_size = self.slots * self.labels_n
+        buf = np.ndarray((policy_size + self.slots,), dtype=np.float32, buffer=self.shm.buf)
+        self.policy = buf[:policy_size].reshape((self.slots, self.labels_n))
+        self.value = buf[policy_size:]
+        self.planes = np.ndarray((self.slots, self.compact_size), dtype=np.uint8, buffer=self.shm.buf,
+                                 offset=(policy_size + self.slots) * 4)
+        self.free = deque(range(self.slots))
+        self.free_cond = Condition()
+
+    def __getstate__(self):
+        return (self.pipe, self.shm.name, self.slots, self.compact_size, self.labels_n, self.owner_tracker)
+
+    def __setstate__(self, state):
+        self.pipe, name, self.slots, self.compact_size, self.labels_n, self.owner_tracker = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        # The block belongs to the process of CChessModelAPI. Attaching registers it with the
+        # resource tracker of this process, which would unlink it when this process exits.
+        # Forked processes share the tracker of their parent and must leave its record alone.
+        if _tracker_pid() != self.owner_tracker:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self._map()
+
+    def acquire(self):
+        '''
+        a free slot, wait if all of them are pending
+        '''
+        with self.free_cond:
+            while not self.free:
+                self.free_cond.wait()
+            return self.free.popleft()
+
+    def release(self, slots):
+        with self.free_cond:
+            self.free.extend(slots)
+            self.free_cond.notify(len(slots))
+
+    def send(self, obj):
+        self.pipe.send(obj)
+
+    def recv(self):
+        return self.pipe.recv()
+
+    def poll(self, timeout=0.0):
+        return self.pipe.poll(timeout)
+
+    def fileno(self):
+        # for multiprocessing.connection.wait
+        return self.pipe.fileno()
+
+    def close(self):
+        '''
+        close the pipe and this mapping of the block, the creator unlinks it
+        '''
+        self.pipe.close()
+        # the views must go before the block can be closed
+        self.policy = self.value = self.planes = None
+        self.shm.close()
+
+
+class SharedEvalCache(EvalCache):
+    '''
+    EvalCache in one block of shared memory, shared by the processes of a machine.
+
+    The table is direct mapped: the entry of a key lives in slot key % slots and replaces
+    whatever was there. Entries are written without a lock between processes, a checksum
+    over the key and the entry tells a torn read from a valid one. Every entry carries the
+    generation it was written in, bumped by model_changed in the first process which sees
+    the new digest, so a model change invalidates the table for all the processes at once.
+    Positions with more than MAX_MOVES legal moves are not cached. Keys are 64 bits.
+    Pickling it sends the name of the block, like SharedMemoryPipe; the creator unlinks it.
+    '''
+    MAX_MOVES = 128
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.block_size(capacity))
+        self.shm.buf[:] = bytes(self.shm.size)
+        self.owner_tracker = _tracker_pid()
+        self.owner = True
+        self._map()
+
+    @classmethod
+    def block_size(cls, slots):
+        # header int64 * 2, then per slot: key uint64, generation int64, value float32,
+        # checksum uint32, number of moves uint16 and the priors float16 * MAX_MOVES
+        return 16 + slots * (8 + 8 + 4 + 4 + 2 + 2 * cls.MAX_MOVES)
+
+    def _map(self):
+        n, buf = self.capacity, self.shm.buf
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=buf)     # generation, digest
+        offset = 16
+        self.keys = np.ndarray((n,), dtype=np.uint64, buffer=buf, offset=offset)
+        offset += 8 * n
+        self.gens = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * n
+        self.values = np.ndarray((n,), dtype=np.float32, buffer=buf, offset=offset)
+        offset += 4 * n
+        self.checks = np.ndarray((n,), dtype=np.uint32, buffer=buf, offset=offset)
+        offset += 4 * n
+        self.counts = np.ndarray((n,), dtype=np.uint16, buffer=buf, offset=offset)
+        offset += 2 * n
+        self.priors = np.ndarray((n, self.MAX_MOVES), dtype=np.float16, buffer=buf, offset=offset)
+
+    def __getstate__(self):
+        return (self.capacity, self.shm.name, self.owner_tracker)
+
+    def __setstate__(self, state):
+        capacity, name, owner_tracker = state
+        EvalCache.__init__(self, capacity)
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner_tracker = owner_tracker
+        self.owner = False
+        # see SharedMemoryPipe.__setstate__
+        if _tracker_pid() != owner_tracker:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self._map()
+
+    @staticmethod
+    def checksum(key, prior, value):
+        return zlib.crc32(prior.tobytes() + np.float32(value).tobytes(), key & 0xffffffff)
+
+    def get(self, key, default=None):
+        i = key % self.capacity
+        entry = default
+        if int(self.keys[i]) == key and self.gens[i] == self.header[0]:
+            k = min(int(self.counts[i]), self.MAX_MOVES)
+            prior = self.priors[i, :k].copy()
+            value = float(self.values[i])
+            if self.checksum(key, prior, value) == self.checks[i] and int(self.keys[i]) == key:
+                entry = (prior, value)
+        with self.lock:
+            if entry is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, prior, value):
+        k = len(prior)
+        if k > self.MAX_MOVES or self.capacity <= 0:
+            return
+        i = key % self.capacity
+        prior = np.asarray(prior, dtype=np.float16)
+        self.keys[i] = 0        # readers miss while the slot is rewritten
+        self.priors[i, :k] = prior
+        self.counts[i] = k
+        self.values[i] = value
+        self.gens[i] = self.header[0]
+        self.checks[i] = self.checksum(key, prior, float(np.float32(value)))
+        self.keys[i] = key
+
+    def model_changed(self, digest):
+        digest = int(digest[:15], 16) if digest else 0
+        if self.header[1] != digest:
+            self.header[1] = digest
+            self.header[0] += 1
+
+    def clear(self):
+        self.header[0] += 1
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return int(np.count_nonzero((self.gens == self.header[0]) & (self.keys != 0)))
+
+    def __contains__(self, key):
+        i = key % self.capacity
+        return int(self.keys[i]) == key and self.gens[i] == self.header[0]
+
+    def close(self):
+        # the views must go before the block can be closed
+        self.header = self.keys = self.gens = self.values = self.checks = self.counts = self.priors = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
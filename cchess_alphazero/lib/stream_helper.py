@@ -0,0 +1,163 @@
+from collections import deque
+from logging import getLogger
+from random import shuffle
+
+import numpy as np
+
+import cchess_alphazero.environment.fast_env as fenv
+from cchess_alphazero.environment.lookup_tables import mirror_policy
+
+logger = getLogger(__name__)
+
+
+def mirror_half(states, policies, rng=np.random):
+    '''
+    mirror a random half of the compact states and their policies left to right, in place
+    '''
+    rows = np.flatnonzero(rng.random_sample(len(states)) < 0.5)
+    states[rows] = fenv.mirror_compact(states[rows])
+    policies[rows] = mirror_policy(policies[rows])
+    return states, policies
+
+
+def array_batches(states, policies, values, batch_size, mirror=False, rng=np.random, weights=None):
+    '''
+    endless shuffled batches of planes from compact in-memory arrays, for Model.fit_generator,
+    with the sample weights of both outputs when weights are given
+    '''
+    n = len(states)
+    while True:
+        order = rng.permutation(n)
+        for i in range(0, n - batch_size + 1, batch_size):
+            idx = np.sort(order[i:i + batch_size])
+            s, p = states[idx], policies[idx]
+            if mirror:
+                s, p = mirror_half(s, p, rng)
+            if weights is None:
+                yield fenv.compact_to_planes(s), [p, values[idx]]
+            else:
+                yield fenv.compact_to_planes(s), [p, values[idx]], [weights[idx], weights[idx]]
+
+
+class ShuffleBuffer:
+    '''
+    A bounded pool of samples (tuples of arrays with one row per sample) from which
+    random rows are taken out, the holes they leave are filled from the tail
+    '''
+    def __init__(self, capacity, rng=np.random):
+        self.capacity = capacity
+        self.rng = rng
+        self.arrays = None
+        self.size = 0
+
+    def free(self):
+        return self.capacity - self.size
+
+    def put(self, arrays):
+        '''
+        copy as many leading rows of arrays as fit, returns their number
+        '''
+        if self.arrays is None:
+            self.arrays = [np.empty((self.capacity,) + x.shape[1:], dtype=x.dtype) for x in arrays]
+        n = min(len(arrays[0]), self.free())
+        for a, x in zip(self.arrays, arrays):
+            a[self.size:self.size + n] = x[:n]
+        self.size += n
+        return n
+
+    def take(self, n):
+        idx = self.rng.choice(self.size, n, replace=False)
+        out = [a[idx] for a in self.arrays]
+        size = self.size - n
+        holes = idx[idx < size]
+        tail = np.setdiff1d(np.arange(size, self.size), idx, assume_unique=True)
+        for a in self.arrays:
+            a[holes] = a[tail]
+        self.size = size
+        return out
+
+
+class PlayDataStream:
+    '''
+    Endless training batches from play data files.
+
+    loader(filename, *args) -> (compact states, policies, values) or None runs in the
+    executor for up to `prefetch` files at a time, its samples go through a ShuffleBuffer
+    of buffer_size rows and batches are expanded to planes as they are taken, so the
+    first batch is ready after buffer_size samples and memory does not depend on the
+    number of files. The files are reshuffled and read again after every pass.
+    With mirror, half of every batch is mirrored left to right.
+    '''
+    def __init__(self, filenames, loader, executor, batch_size, buffer_size, prefetch=8, args=(), mirror=False):
+        self.filenames = list(filenames)
+        self.loader = loader
+        self.executor = executor
+        self.batch_size = batch_size
+        self.buffer = ShuffleBuffer(max(buffer_size, batch_size))
+        self.prefetch = prefetch
+        self.args = args
+        self.mirror = mirror
+        self.files = deque()
+        self.bad = set()    # files without samples, the loader removes broken files
+        self.pending = deque()
+        self.leftover = deque()
+        self.passes = 0
+        self.files_loaded = 0
+        self.samples_loaded = 0
+
+    def next_file(self):
+        while True:
+            if not self.files:
+                if len(self.bad) >= len(self.filenames):
+                    raise RuntimeError("No training data in the play data files")
+                files = list(self.filenames)
+                shuffle(files)
+                self.files = deque(files)
+                self.passes += 1
+            filename = self.files.popleft()
+            if filename not in self.bad:
+                return filename
+
+    def load_one(self):
+        while len(self.pending) < self.prefetch:
+            filename = self.next_file()
+            self.pending.append((filename, self.executor.submit(self.loader, filename, *self.args)))
+        filename, future = self.pending.popleft()
+        arrays = future.result()
+        if arrays is None or len(arrays[0]) == 0:
+            self.bad.add(filename)
+            return
+        self.files_loaded += 1
+        self.samples_loaded += len(arrays[0])
+        self.leftover.append(arrays)
+
+    def fill(self):
+        while self.buffer.free() > 0:
+            if not self.leftover:
+                self.load_one()
+                continue
+            arrays = self.leftover.popleft()
+            n = self.buffer.put(arrays)
+            if n < len(arrays[0]):
+                self.leftover.appendleft([x[n:] for x in arrays])
+
+    def samples_per_file(self):
+        return self.samples_loaded / max(self.files_loaded, 1)
+
+    def take(self, n, mirror=None):
+        self.fill()
+        states, policy, value = self.buffer.take(n)
+        if self.mirror if mirror is None else mirror:
+            states, policy = mirror_half(states, policy)
+        return fenv.compact_to_planes(states), policy, value
+
+    def close(self):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.leftover.clear()
+
+    def batches(self):
+        while True:
+            planes, policy, value = self.take(self.batch_size)
+            yield planes, [policy, value]
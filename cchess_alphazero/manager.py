@@ -8,7 +8,7 @@ from cchess_alphazero.config import Config, PlayWithHumanConfig
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob']
+CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob', 'convert']
 PIECE_STYLE_LIST = ['WOOD', 'POLISH', 'DELICATE']
 BG_STYLE_LIST = ['CANVAS', 'DROPS', 'GREEN', 'QIANHONG', 'SHEET', 'SKELETON', 'WHITE', 'WOOD']
 RANDOM_LIST = ['none', 'small', 'medium', 'large']
@@ -48,6 +48,8 @@ def setup(config: Config, args):
         setup_logger(config.resource.eval_log_path)
     elif args.cmd == 'sl':
         setup_logger(config.resource.sl_log_path)
+    elif args.cmd == 'convert':
+        setup_logger(config.resource.main_log_path)
 
 def start():
     parser = create_parser()
@@ -114,4 +116,8 @@ def start():
         pwhc = PlayWithHumanConfig()
         pwhc.update_play_config(config.play)
         ob_self_play.start(config, args.ucci, args.ai_move_first)
+    elif args.cmd == 'convert':
+        from cchess_alphazero.lib.data_helper import convert_game_data_files
+        n = convert_game_data_files(config.resource, config.play_data.chunks_per_file)
+        logger.info(f"Converted {n} games to chunk files")
         
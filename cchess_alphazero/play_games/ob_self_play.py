@@ -9,7 +9,7 @@ import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.environment.chessboard import Chessboard
 from cchess_alphazero.environment.chessman import *
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
@@ -45,7 +45,7 @@ class ObSelfPlay:
         self.env.reset()
         self.load_model()
         self.pipe = self.model.get_pipes()
-        self.ai = CChessPlayer(self.config, search_tree=defaultdict(VisitState), pipes=self.pipe,
+        self.ai = CChessPlayer(self.config, search_tree=new_search_tree(self.config), pipes=self.pipe,
                               enable_resign=True, debugging=False)
 
         labels = ActionLabelsRed
@@ -99,7 +99,7 @@ class ObSelfPlayUCCI:
         self.env.reset()
         self.load_model()
         self.pipe = self.model.get_pipes()
-        self.ai = CChessPlayer(self.config, search_tree=defaultdict(VisitState), pipes=self.pipe,
+        self.ai = CChessPlayer(self.config, search_tree=new_search_tree(self.config), pipes=self.pipe,
                               enable_resign=True, debugging=False)
 
         labels = ActionLabelsRed
@@ -14,10 +14,11 @@ from time import sleep
 from datetime import datetime
 
 import cchess_alphazero.environment.static_env as senv
+import cchess_alphazero.environment.fast_env as fenv
 from cchess_alphazero.environment.chessboard import Chessboard
 from cchess_alphazero.environment.chessman import *
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
@@ -99,7 +100,7 @@ class PlayWithHuman:
         self.env.reset()
         self.load_model()
         self.pipe = self.model.get_pipes()
-        self.ai = CChessPlayer(self.config, search_tree=defaultdict(VisitState), pipes=self.pipe,
+        self.ai = CChessPlayer(self.config, search_tree=new_search_tree(self.config), pipes=self.pipe,
                               enable_resign=True, debugging=True)
         self.human_move_first = human_first
 
@@ -223,7 +224,7 @@ class PlayWithHuman:
                 self.history.append(action)
                 if not self.env.red_to_move:
                     action = flip_move(action)
-                key = self.env.get_state()
+                key = fenv.state_key(state)
                 p, v = self.ai.debug[key]
                 logger.info(f"check = {check}, NN value = {v:.3f}")
                 self.nn_value = v
@@ -99,15 +99,19 @@ def test_wxf():
 def test_sl():
     from cchess_alphazero.worker import sl
     from cchess_alphazero.config import Config
-    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, flip_move
+    from cchess_alphazero.environment.env import CChessEnv
+    from cchess_alphazero.environment.lookup_tables import Move_2_Idx, Unflipped_index
     c = Config('mini')
-    labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-    slworker = sl.SupervisedWorker(c)
-    p1 = slworker.build_policy('0001', False)
-    print(p1[move_lookup['0001']])
-    p2 = slworker.build_policy('0001', True)
-    print(p2[move_lookup[flip_move('0001')]])
+    env = CChessEnv(c).reset()
+    red_action = env.board.parse_WXF_move('C2.5')
+    env.step(red_action)
+    black_action = env.board.parse_WXF_move('H8+7')
+    # the last turn is not encoded
+    states, policies, values, skipped = sl.encode_sl_game(c, {1: 'C2.5', 2: 'H2+3'}, {1: 'H8+7', 2: 'R9.8'}, 'red')
+    assert policies == [Move_2_Idx[red_action], Unflipped_index[Move_2_Idx[black_action]]]
+    assert values == [1, -1]
+    assert skipped == 0
+    assert sl.encode_sl_game(c, {1: 'X9.9', 2: 'H2+3'}, {1: 'H8+7', 2: 'R9.8'}, 'red') is None
 
 def test_static_env():
     from cchess_alphazero.environment.env import CChessEnv
@@ -243,6 +247,8 @@ def fixbug():
     fix = 0
     draw_cnt = 0
     for filename in files:
+        if not filename.endswith('.json'):
+            continue
         try:
             data = read_game_data_from_file(filename)
         except:
@@ -266,7 +272,7 @@ def fixbug():
                 break
             state = senv.step(state, action)
             is_red_turn = not is_red_turn
-            real_data.append([action, value])
+            real_data.append([action, value] + item[2:])
         if not draw:
             game_over, v, final_move = senv.done(state)
             if final_move:
@@ -327,6 +333,387 @@ def test_be_catched():
     action = '4454'
     print(senv.be_catched(ori_state, action))
     
+def test_fast_env():
+    import random
+    import cchess_alphazero.environment.static_env as senv
+    import cchess_alphazero.environment.fast_env as fenv
+    def perft(env, state, depth):
+        # static_env may list the face-to-face king capture more than once
+        moves = set(env.get_legal_moves(state))
+        if depth == 1:
+            return len(moves)
+        return sum(perft(env, env.step(state, mov), depth - 1) for mov in moves)
+    for depth in range(1, 4):
+        a = perft(senv, senv.INIT_STATE, depth)
+        b = perft(fenv, senv.INIT_STATE, depth)
+        print(f"perft({depth}): static_env = {a}, fast_env = {b}")
+        assert a == b
+    # random games
+    cnt = 0
+    for i in range(20):
+        state = senv.INIT_STATE
+        pos = fenv.Position()
+        for turns in range(200):
+            assert pos.state() == state and pos.key == fenv.state_key(state), state
+            assert pos.other == fenv.flip_board(pos.board), state
+            moves = fenv.get_legal_moves(state)
+            assert list(dict.fromkeys(senv.get_legal_moves(state))) == moves, state
+            assert senv.done(state, need_check=True) == fenv.done(state, need_check=True), state
+            for mov in moves[:3]:
+                assert senv.new_step(state, mov) == fenv.new_step(state, mov), (state, mov)
+                assert senv.will_check_or_catch(state, mov) == fenv.will_check_or_catch(state, mov), (state, mov)
+                assert senv.be_catched(state, mov) == fenv.be_catched(state, mov), (state, mov)
+            cnt += 1
+            mov = random.choice(moves)
+            state = senv.step(state, mov)
+            pos.make(mov)
+            if senv.done(state)[0]:
+                break
+        while pos.stack:
+            pos.unmake()
+        assert pos.state() == senv.INIT_STATE and pos.key == fenv.state_key(senv.INIT_STATE)
+    print(f"{cnt} positions checked")
+
+def test_compact_planes():
+    import random
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    import cchess_alphazero.environment.fast_env as fenv
+    state = senv.INIT_STATE
+    history = [state]
+    pos = fenv.Position()
+    states, compacts, planes = [], [], []
+    for turns in range(100):
+        assert pos.compact() == fenv.state_to_compact(state), state
+        compacts.append(fenv.state_history_to_compact(state, history))
+        planes.append(senv.state_history_to_planes(state, history))
+        moves = senv.get_legal_moves(state)
+        mov = random.choice(moves)
+        state = senv.step(state, mov)
+        pos.make(mov)
+        history += [mov, state]
+        if senv.done(state)[0]:
+            break
+    expanded = fenv.compact_to_planes(fenv.compact_array(compacts))
+    assert (expanded == np.asarray(planes)).all()
+    assert (expanded[:, :14] == np.asarray([senv.state_to_planes(s) for s in history[::2][:len(compacts)]])).all()
+    print(f"{len(compacts)} positions checked")
+
+def test_expand_games():
+    import random
+    import time
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+    from cchess_alphazero.worker import optimize
+    games = []
+    for g in range(20):
+        state = senv.INIT_STATE
+        data = [state]
+        value = 1 if g % 3 else 0
+        for turns in range(150):
+            moves = senv.get_legal_moves(state)
+            mov = random.choice(moves)
+            visits = [[ActionLabelsRed.index(m), random.randint(1, 100)] for m in moves] if g % 2 else None
+            data.append([mov, value] + ([visits] if visits else []))
+            value = -value
+            state = senv.step(state, mov)
+            if senv.done(state)[0]:
+                break
+        games.append(data)
+    n = sum(len(data) - 1 for data in games)
+    for use_history in (False, True):
+        start = time.time()
+        before = []
+        for data in games:
+            # the replay before expand_games: a string step and a policy per move
+            state = data[0]
+            real_data, history = [], [state]
+            for item in data[1:]:
+                if len(item) > 2:
+                    policy = optimize.build_visit_policy(item[2])
+                else:
+                    policy = optimize.build_policy(item[0], flip=False)
+                real_data.append([state, policy, item[1]])
+                state = senv.step(state, item[0])
+                history += [item[0], state]
+            before.append(optimize.convert_to_trainging_data(real_data, history if use_history else None))
+        before = [np.concatenate(ary) for ary in zip(*before)]
+        t0 = time.time() - start
+        start = time.time()
+        after = optimize.expand_games(games, use_history)
+        t1 = time.time() - start
+        for x, y in zip(before, after):
+            assert np.allclose(x, y)
+        print(f"history={use_history}: {n} positions, before {n / t0:.0f}/s, after {n / t1:.0f}/s")
+
+def test_mirror():
+    import random
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    import cchess_alphazero.environment.fast_env as fenv
+    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Move_2_Idx, mirror_move, mirror_policy
+    state = senv.INIT_STATE
+    for turns in range(100):
+        compact = np.frombuffer(fenv.state_to_compact(state), dtype=np.uint8).reshape(1, -1)
+        mirrored = fenv.mirror_compact(compact)
+        # the mirrored position as a state: the rows of the fen reversed
+        rows = state.split('/')
+        mstate = '/'.join([row.translate(fenv._EXPAND_DIGITS)[::-1] for row in rows])
+        assert (mirrored == np.frombuffer(fenv.state_to_compact(mstate), dtype=np.uint8)).all()
+        moves = senv.get_legal_moves(state)
+        assert sorted(mirror_move(m) for m in moves) == sorted(fenv.Position(mstate).legal_moves())
+        policy = np.zeros(len(ActionLabelsRed))
+        policy[[Move_2_Idx[m] for m in moves]] = 1
+        assert (np.flatnonzero(mirror_policy(policy)) == np.sort([Move_2_Idx[mirror_move(m)] for m in moves])).all()
+        state = senv.step(state, random.choice(moves))
+        if senv.done(state)[0]:
+            break
+    print(f"{turns} positions checked")
+
+
+def test_search_threads():
+    '''
+    simulations per second of CChessPlayer against search_threads, with a random network
+    answering in its own thread like CChessModelAPI
+    '''
+    import time
+    import threading
+    import numpy as np
+    from multiprocessing import Pipe
+    import cchess_alphazero.environment.static_env as senv
+    from cchess_alphazero.config import Config
+    from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
+    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+
+    def fake_api(pipe, stop):
+        while not stop.is_set():
+            if pipe.poll(0.01):
+                n = len(pipe.recv())
+                policy = np.random.dirichlet(np.ones(len(ActionLabelsRed)), n).astype(np.float32)
+                pipe.send([(p, float(v)) for p, v in zip(policy, np.random.uniform(-1, 1, n))])
+
+    config = Config('distribute')
+    config.play.simulation_num_per_move = 800
+    for threads in (1, 2, 4, 8, 16, 32, 64):
+        config.play.search_threads = threads
+        me, you = Pipe()
+        stop = threading.Event()
+        api = threading.Thread(target=fake_api, args=(me, stop), daemon=True)
+        api.start()
+        player = CChessPlayer(config, search_tree=new_search_tree(config), pipes=you)
+        state = senv.INIT_STATE
+        start = time.time()
+        for turns in range(6):
+            action, _ = player.action(state, turns)
+            state = senv.step(state, action)
+        print(f"search_threads = {threads}: {6 * 800 / (time.time() - start):.0f} simulations/s")
+        player.close()
+        stop.set()
+        api.join()
+        me.close()
+        you.close()
+
+def test_eval_cache():
+    '''
+    with and without history planes, every entry of the evaluation cache must be the evaluation
+    of the planes of its leaf; also prints the hit rate of a few short games sharing the cache
+    '''
+    import hashlib
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    from cchess_alphazero.config import Config
+    from cchess_alphazero.agent.player import BatchPlayer
+    from cchess_alphazero.lib.cache_helper import EvalCache
+
+    def evaluate(planes):
+        # a random network which gives the same answer for the same planes
+        rng = np.random.RandomState(int.from_bytes(hashlib.md5(bytes(planes)).digest()[:4], 'little'))
+        p = rng.rand(2086).astype(np.float32)
+        return p / p.sum(), float(rng.uniform(-1, 1))
+
+    config = Config('mini')
+    config.play.simulation_num_per_move = 100
+    for use_history in (False, True):
+        cache = EvalCache(100000)
+        planes_of = {}
+        for game in range(3):
+            player = BatchPlayer(config, use_history=use_history, eval_cache=cache)
+            state = senv.INIT_STATE
+            for turns in range(10):
+                if senv.done(state)[0]:
+                    break
+                player.start_search(state, turns)
+                while not player.search_done():
+                    for planes, history in player.collect_leaves(8):
+                        key = player.eval_key(history)
+                        assert planes_of.setdefault(key, bytes(planes)) == bytes(planes)
+                        player.backup(*evaluate(planes), history)
+                action, _ = player.choose_action(state, turns)
+                state = senv.step(state, action)
+        for key, (_, value) in cache.data.items():
+            assert abs(evaluate(planes_of[key])[1] - value) < 1e-6
+        print(f"use_history = {use_history}: {cache.stats()}")
+
+def test_batch_target_above_max():
+    '''
+    a batch_target above batch_max is used as batch_max: the requests are predicted at once
+    instead of waiting for the deadline
+    '''
+    import time
+    from contextlib import contextmanager
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    import cchess_alphazero.environment.fast_env as fenv
+    from cchess_alphazero.config import Config
+    from cchess_alphazero.agent.api import CChessModelAPI
+    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+
+    class FakeModel:
+        def __init__(self):
+            self.sizes = []
+
+        def predict_on_batch(self, planes):
+            self.sizes.append(len(planes))
+            n = len(planes)
+            return np.full((n, len(ActionLabelsRed)), 1 / len(ActionLabelsRed), dtype=np.float32), np.zeros((n, 1))
+
+    class FakeAgent:
+        def __init__(self):
+            self.model = FakeModel()
+
+        @contextmanager
+        def as_default(self):
+            yield
+
+        @property
+        def graph(self):
+            return self
+
+    config = Config('mini')
+    config.play.batch_max = 4
+    config.play.batch_target = 8
+    config.play.batch_max_wait_us = 10 * 1000 * 1000
+    agent = FakeAgent()
+    api = CChessModelAPI(config, agent)
+    pipe = api.get_pipe(need_reload=False)
+    api.start(need_reload=False)
+    start = time.time()
+    pipe.send([fenv.state_to_compact(senv.INIT_STATE)] * 3)
+    pipe.send([fenv.state_to_compact(senv.INIT_STATE)] * 3)
+    answers = pipe.recv() + pipe.recv()
+    api.close()
+    assert len(answers) == 6
+    assert time.time() - start < 5
+    assert max(agent.model.sizes) <= config.play.batch_max
+
+def test_tree_eviction():
+    '''
+    a batched search in a tree much smaller than the search: the eviction must keep the nodes
+    of the simulations still waiting for their leaf, so that no visit count goes below 0
+    '''
+    import hashlib
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    from cchess_alphazero.config import Config
+    from cchess_alphazero.agent.player import BatchPlayer
+
+    def evaluate(planes):
+        rng = np.random.RandomState(int.from_bytes(hashlib.md5(bytes(planes)).digest()[:4], 'little'))
+        p = rng.rand(2086).astype(np.float32)
+        return p / p.sum(), float(rng.uniform(-1, 1))
+
+    config = Config('mini')
+    config.play.simulation_num_per_move = 2000
+    config.play.max_tree_nodes = 200
+    config.play.eval_cache_size = 0
+    for use_history in (False, True):
+        player = BatchPlayer(config, use_history=use_history)
+        state = senv.INIT_STATE
+        for turns in range(4):
+            player.start_search(state, turns)
+            while not player.search_done():
+                for planes, history in player.collect_leaves(40):
+                    player.backup(*evaluate(planes), history)
+            assert len(player.tree) <= config.play.max_tree_nodes
+            for node in player.tree.values():
+                assert node.pending == 0
+                assert all(n >= 0 for _, n, _, _ in node.edges())
+            assert set(player.history_states) <= set(player.tree)
+            action, policy = player.choose_action(state, turns)
+            assert np.isfinite(policy).all()
+            state = senv.step(state, action)
+        print(f"use_history = {use_history}: {player.tree.evicted} nodes evicted")
+
+def test_uci_search(capsys):
+    '''
+    a short search of a uci player with a random network, which prints its info depth lines
+    '''
+    import threading
+    import numpy as np
+    from multiprocessing import Pipe
+    import cchess_alphazero.environment.static_env as senv
+    from cchess_alphazero.config import Config
+    from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
+    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+
+    def fake_api(pipe, stop):
+        while not stop.is_set():
+            if pipe.poll(0.01):
+                n = len(pipe.recv())
+                policy = np.random.dirichlet(np.ones(len(ActionLabelsRed)), n).astype(np.float32)
+                pipe.send([(p, float(v)) for p, v in zip(policy, np.random.uniform(-1, 1, n))])
+
+    config = Config('mini')
+    config.play.simulation_num_per_move = 300
+    me, you = Pipe()
+    stop = threading.Event()
+    api = threading.Thread(target=fake_api, args=(me, stop), daemon=True)
+    api.start()
+    player = CChessPlayer(config, search_tree=new_search_tree(config), pipes=you,
+                          enable_resign=False, debugging=True, uci=True)
+    # in a thread, so that a broken search fails the test instead of leaving it waiting
+    result = []
+    search = threading.Thread(target=lambda: result.append(player.action(senv.INIT_STATE, 0)), daemon=True)
+    search.start()
+    search.join(60)
+    player.close(wait=False)
+    stop.set()
+    api.join()
+    me.close()
+    you.close()
+    assert result, 'the search did not finish'
+    assert result[0][0] in senv.get_legal_moves(senv.INIT_STATE)
+    lines = [l for l in capsys.readouterr().out.splitlines() if l.startswith('info depth')]
+    assert len(lines) == 3
+    assert all(len(l.split(' pv ')[1].split(' nps ')[0].split()) > 0 for l in lines)
+
+def test_replay_window():
+    '''
+    a fresh windowed replay buffer only trains and validates on the rows written so far
+    '''
+    import tempfile
+    import numpy as np
+    import cchess_alphazero.environment.static_env as senv
+    import cchess_alphazero.environment.fast_env as fenv
+    from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+    from cchess_alphazero.lib.replay_helper import ReplayBuffer
+
+    n = 50
+    labels_n = len(ActionLabelsRed)
+    with tempfile.TemporaryDirectory() as directory:
+        rb = ReplayBuffer(directory, 1000, fenv.BOARD_SIZE, labels_n, window=4, holdout=0.1)
+        states = fenv.compact_array([fenv.state_to_compact(senv.INIT_STATE)] * n)
+        policies = np.random.dirichlet(np.ones(labels_n), n).astype(np.float32)
+        rb.add(states, policies, np.ones(n))
+        assert len(rb) == n - rb.holdout[:n].sum()
+        assert (rb.holdout_rows() < n).all()
+        planes, policy, value = rb.sample(64)
+        assert (planes.reshape(64, -1).sum(axis=1) > 0).all()
+        assert np.allclose(policy.sum(axis=1), 1, atol=1e-3)
+        assert (value == 1).all()
+        planes, policy, value = rb.validation_batch(64)
+        assert len(value) == rb.holdout[:n].sum() and (value == 1).all()
 
 if __name__ == "__main__":
     test_be_catched()
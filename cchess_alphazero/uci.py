@@ -27,8 +27,9 @@ setup_file_logger(config.resource.play_log_path)
 sys.stderr = open(config.resource.play_log_path, 'a')
 
 import cchess_alphazero.environment.static_env as senv
+import cchess_alphazero.environment.fast_env as fenv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree, new_eval_cache
 from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move
 from cchess_alphazero.lib.model_helper import load_model_weight
 from cchess_alphazero.lib.tf_util import set_session_config
@@ -47,9 +48,11 @@ class UCI:
         self.model = None
         self.pipe = None
         self.is_ready = False
-        self.search_tree = defaultdict(VisitState)
+        self.search_tree = new_search_tree(self.config)
+        self.eval_cache = None      # kept across searches and games, made once the model is loaded
         self.remain_time = None
         self.history = None
+        self.keys = None        # zobrist keys of the states in history
         self.turns = 0
         self.start_time = None
         self.end_time = None
@@ -79,19 +82,22 @@ class UCI:
         set_session_config(per_process_gpu_memory_fraction=1, allow_growth=True, 
             device_list=self.config.opts.device_list)
         self.use_history = self.load_model()
+        self.eval_cache = new_eval_cache(self.config, self.model.digest)
         self.is_ready = True
         self.turns = 0
         self.remain_time = None
         self.state = senv.INIT_STATE
         self.history = [self.state]
+        self.keys = [fenv.state_key(self.state)]
         self.is_red_turn = True
 
     def cmd_ucinewgame(self):
         self.state = senv.INIT_STATE
         self.history = [self.state]
+        self.keys = [fenv.state_key(self.state)]
         self.is_ready = True
         self.is_red_turn = True
-        self.search_tree = defaultdict(VisitState)
+        self.search_tree = new_search_tree(self.config)
 
     def cmd_setoption(self):
         '''
@@ -139,12 +145,14 @@ class UCI:
                 else:
                     self.is_red_turn = True
                     self.turns = (int(self.args[6]) - 1) * 2
+                self.keys = [fenv.state_key(self.state)]
                 if len(self.args) > 7 and self.args[7] == 'moves':
                     move_idx = 8
             elif self.args[0] == 'startpos':
                 self.state = senv.INIT_STATE
                 self.is_red_turn = True
                 self.history = [self.state]
+                self.keys = [fenv.state_key(self.state)]
                 self.turns = 0
                 if len(self.args) > 1 and self.args[1] == 'moves':
                     move_idx = 2
@@ -154,6 +162,7 @@ class UCI:
             self.state = senv.INIT_STATE
             self.is_red_turn = True
             self.history = [self.state]
+            self.keys = [fenv.state_key(self.state)]
             self.turns = 0
         logger.debug(f"state = {self.state}")
         # senv.render(self.state)
@@ -164,10 +173,11 @@ class UCI:
                 if not self.is_red_turn:
                     action = flip_move(action)
                 self.history.append(action)
-                self.state = senv.step(self.state, action)
+                self.state, key, _ = fenv.key_step(self.state, self.keys[-1], action)
                 self.is_red_turn = not self.is_red_turn
                 self.turns += 1
                 self.history.append(self.state)
+                self.keys.append(key)
             logger.debug(f"state = {self.state}")
             # senv.render(self.state)
     
@@ -203,10 +213,11 @@ class UCI:
         self.remain_time = None
         self.model.close_pipes()
         self.pipe = self.model.get_pipes(need_reload=False)
-        self.search_tree = defaultdict(VisitState)
+        if not self.config.play.tree_reuse:
+            self.search_tree = new_search_tree(self.config)
         self.player = CChessPlayer(self.config, search_tree=self.search_tree, pipes=self.pipe,
                                     enable_resign=False, debugging=True, uci=True, 
-                                    use_history=self.use_history, side=self.turns % 2)
+                                    use_history=self.use_history, side=self.turns % 2, eval_cache=self.eval_cache)
         for i in range(len(self.args)):
             if self.args[i] == 'depth':
                 depth = int(self.args[i + 1]) * 100
@@ -240,15 +251,18 @@ class UCI:
             return
         if self.player:
             no_act = None
-            if self.state in self.history[:-1]:
+            key = self.keys[-1]
+            if key in self.keys[:-1]:
                 no_act = []
-                for i in range(len(self.history) - 1):
-                    if self.history[i] == self.state:
-                        no_act.append(self.history[i + 1])
+                for i in range(len(self.keys) - 1):
+                    if self.keys[i] == key:
+                        no_act.append(self.history[i * 2 + 1])
             action, value, depth = self.player.close_and_return_action(self.state, self.turns, no_act)
             self.player = None
             self.model.close_pipes()
             self.info_best_move(action, value, depth)
+            # the interrupted simulations left virtual losses in the tree
+            self.search_tree = new_search_tree(self.config)
         else:
             logger.error(f"bestmove none")
 
@@ -278,18 +292,19 @@ class UCI:
         no_act = None
         _, _, _, check = senv.done(self.state, need_check=True)
         logger.debug(f"Check = {check}, state = {self.state}")
-        if not check and self.state in self.history[:-1]:
+        key = self.keys[-1]
+        if not check and key in self.keys[:-1]:
             no_act = []
-            for i in range(len(self.history) - 1):
-                if self.history[i] == self.state:
-                    if senv.will_check_or_catch(self.state, self.history[i+1]):
-                        no_act.append(self.history[i + 1])
+            for i in range(len(self.keys) - 1):
+                if self.keys[i] == key:
+                    if senv.will_check_or_catch(self.state, self.history[i * 2 + 1]):
+                        no_act.append(self.history[i * 2 + 1])
                         logger.debug(f"Foul: no act = {no_act}")
         action, _ = self.player.action(self.state, self.turns, no_act=no_act, depth=depth, 
                                         infinite=infinite, hist=self.history)
         if self.t:
             self.t.cancel()
-        _, value = self.player.debug[self.state]
+        _, value = self.player.debug[key]
         depth = self.player.done_tasks // 100
         self.player.close(wait=False)
         self.player = None
@@ -305,17 +320,19 @@ class UCI:
         nps = int(depth * 100 / duration) * 1000
         print(f"info depth {depth} score {score} time {int(duration * 1000)} nps {nps}")
         logger.debug(f"info depth {depth} score {score} time {int((self.end_time - self.start_time) * 1000)}")
+        if self.eval_cache is not None:
+            logger.debug(f"eval cache: {self.eval_cache.stats()}")
         sys.stdout.flush()
         # get ponder
-        state = senv.step(self.state, action)
+        _, key, _ = fenv.key_step(self.state, self.keys[-1], action)
         ponder = None
-        if state in self.search_tree:
-            node = self.search_tree[state]
+        if key in self.search_tree:
+            node = self.search_tree[key]
             cnt = 0
-            for mov, action_state in node.a.items():
-                if action_state.n > cnt:
+            for mov, n, _, _ in node.edges():
+                if n > cnt:
                     ponder = mov
-                    cnt = action_state.n
+                    cnt = n
         if not self.is_red_turn:
             action = flip_move(action)
         action = senv.to_uci_move(action)
@@ -17,11 +17,11 @@ from random import random, randint
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, build_policy, flip_move
 from cchess_alphazero.lib.data_helper import write_game_data_to_file
 from cchess_alphazero.lib.model_helper import load_model_weight
 from cchess_alphazero.lib.tf_util import set_session_config
@@ -215,9 +215,9 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data, hist_base, hist_
     pipe1 = pipes_bt.pop() # borrow
     pipe2 = pipes_ng.pop()
 
-    player1 = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe1, 
+    player1 = CChessPlayer(config, search_tree=new_search_tree(config), pipes=pipe1, 
         enable_resign=False, debugging=False, use_history=hist_base)
-    player2 = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe2, 
+    player2 = CChessPlayer(config, search_tree=new_search_tree(config), pipes=pipe2, 
         enable_resign=False, debugging=False, use_history=hist_ng)
 
     # even: bst = red, ng = black; odd: bst = black, ng = red
@@ -328,14 +328,3 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data, hist_base, hist_
     pipes_bt.append(pipe1)
     pipes_ng.append(pipe2)
     return (turns, v, idx), data
-
-def build_policy(action, flip):
-    labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-    policy = np.zeros(labels_n)
-
-    policy[move_lookup[action]] = 1
-
-    if flip:
-        policy = flip_policy(policy)
-    return list(policy)
@@ -14,7 +14,7 @@ import numpy as np
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree, new_eval_cache
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
@@ -89,11 +89,16 @@ class EvaluateWorker:
         self.pid = pid
         self.pipes_bt = pipes1
         self.pipes_ng = pipes2
+        self.cache_bt = None    # evaluation caches of the two models, made in start
+        self.cache_ng = None
 
     def start(self):
         ran = self.config.play.max_processes * 2
         sleep((self.pid % ran) * 10)
         logger.debug(f"Evaluate#Start Process index = {self.pid}, pid = {os.getpid()}")
+        # the models are not reloaded during the evaluation
+        self.cache_bt = new_eval_cache(self.config)
+        self.cache_ng = new_eval_cache(self.config)
         score = 0
         total_score = 0
         red_new_win = 0
@@ -141,23 +146,25 @@ class EvaluateWorker:
 
             logger.info(f"进程{self.pid}评测完毕 用时{(end_time - start_time):.1f}秒, "
                          f"{turns / 2}回合, {result}, 得分：{score}, value = {value}, idx = {idx}")
+            if self.cache_bt is not None:
+                logger.debug(f"Eval cache: best model {self.cache_bt.stats()}, next generation {self.cache_ng.stats()}")
             total_score += score
         return (total_score, red_new_win, red_new_draw, red_new_fail, black_new_win, black_new_draw, black_new_fail)
 
     def start_game(self, idx):
         pipe1 = self.pipes_bt.pop()
         pipe2 = self.pipes_ng.pop()
-        search_tree1 = defaultdict(VisitState)
-        search_tree2 = defaultdict(VisitState)
+        search_tree1 = new_search_tree(self.config)
+        search_tree2 = new_search_tree(self.config)
 
         playouts = randint(8, 12) * 100
         self.config.play.simulation_num_per_move = playouts
         logger.info(f"Set playouts = {self.config.play.simulation_num_per_move}")
 
         self.player1 = CChessPlayer(self.config, search_tree=search_tree1, pipes=pipe1, 
-                        debugging=False, enable_resign=False)
+                        debugging=False, enable_resign=False, eval_cache=self.cache_bt)
         self.player2 = CChessPlayer(self.config, search_tree=search_tree2, pipes=pipe2, 
-                        debugging=False, enable_resign=False)
+                        debugging=False, enable_resign=False, eval_cache=self.cache_ng)
 
         # even: bst = red, ng = black; odd: bst = black, ng = red
         if idx % 2 == 0:
@@ -14,13 +14,17 @@ from random import shuffle
 from threading import Thread
 
 import cchess_alphazero.environment.static_env as senv
+import cchess_alphazero.environment.fast_env as fenv
 from cchess_alphazero.agent.model import CChessModel
 from cchess_alphazero.config import Config
-from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
+from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_games_from_file
 from cchess_alphazero.lib.model_helper import load_best_model_weight, save_as_best_model
 from cchess_alphazero.lib.model_helper import need_to_reload_best_model_weight, save_as_next_generation_model, save_as_best_model
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move, build_policy, Move_2_Idx
+from cchess_alphazero.lib.dedup_helper import dedup_samples, sample_weights
+from cchess_alphazero.lib.replay_helper import ReplayBuffer
+from cchess_alphazero.lib.stream_helper import PlayDataStream, array_batches
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import http_request
 
@@ -42,15 +46,32 @@ class OptimizeWorker:
         self.loaded_filenames = set()
         self.loaded_data = deque(maxlen=self.config.trainer.dataset_size)
         self.dataset = deque(), deque(), deque()
+        self.counts = None      # samples each of the first rows of the dataset stands for once merged by dedup
         self.executor = ProcessPoolExecutor(max_workers=config.trainer.cleaning_processes)
         self.filenames = []
         self.opt = None
         self.count = 0
         self.eva = False
+        self.replay = None
 
     def start(self):
         self.model = self.load_model()
-        self.training()
+        tc = self.config.trainer
+        if tc.replay_buffer_size > 0:
+            compact_size = fenv.BOARD_SIZE * (2 if self.config.opts.has_history else 1)
+            self.replay = ReplayBuffer(self.config.resource.replay_buffer_dir, tc.replay_buffer_size,
+                                       compact_size, len(ActionLabelsRed), window=tc.replay_window)
+        if tc.continuous:
+            if self.replay is None:
+                raise RuntimeError("Continuous training needs the replay buffer, set TrainerConfig.replay_buffer_size")
+            self.continuous_training()
+        else:
+            self.training()
+
+    def dataset_len(self):
+        if self.replay is not None:
+            return len(self.replay)
+        return len(self.dataset[0])
 
     def training(self):
         self.compile_model()
@@ -88,26 +109,88 @@ class OptimizeWorker:
                 self.filenames = deque(files)
                 logger.debug(f"Start training {len(self.filenames)} files")
                 shuffle(self.filenames)
-                self.fill_queue()
-                self.update_learning_rate(total_steps)
-                if len(self.dataset[0]) > self.config.trainer.batch_size:
-                    steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
+                if self.config.trainer.streaming and self.replay is None:
+                    self.update_learning_rate(total_steps)
+                    steps = self.train_epoch_from_stream(self.config.trainer.epoch_to_checkpoint)
+                else:
+                    self.fill_queue()
+                    if self.config.trainer.dedup and self.replay is None:
+                        self.dedup_dataset()
+                    self.update_learning_rate(total_steps)
+                    steps = 0
+                    if self.dataset_len() > self.config.trainer.batch_size:
+                        steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
+                if steps > 0:
                     total_steps += steps
                     self.save_current_model(send=False)
                     self.update_learning_rate(total_steps)
                     self.count += 1
-                    a, b, c = self.dataset
-                    a.clear()
-                    b.clear()
-                    c.clear()
-                    del self.dataset, a, b, c
+                    if self.replay is not None:
+                        self.replay.new_generation()
+                    del self.dataset
                     gc.collect()
                     self.dataset = deque(), deque(), deque()
+                    self.counts = None
                     self.backup_play_data(files)
 
+    def continuous_training(self):
+        '''
+        Never exits: new play data files are ingested into the replay buffer as they appear and
+        every new sample pays for train_ratio trained samples. The model is saved as the best
+        model every checkpoint_interval seconds.
+        '''
+        tc = self.config.trainer
+        self.compile_model()
+        total_steps = tc.start_total_steps
+        budget = 0          # samples that may be trained before new data is needed
+        last_save = time.time()
+        while True:
+            files = self.settled_play_data()
+            if files:
+                self.filenames = deque(files)
+                loaded = self.fill_queue()
+                budget += loaded * tc.train_ratio
+                self.replay.new_generation()
+                self.backup_play_data(files)
+                logger.info(f"Ingest {len(files)} files, {loaded} samples, replay buffer {len(self.replay)} samples")
+            steps = min(int(budget) // tc.batch_size, tc.dataset_size // tc.batch_size)
+            if steps > 0 and len(self.replay) >= max(tc.batch_size, tc.min_data_size_to_learn):
+                self.update_learning_rate(total_steps)
+                self.train_epoch_from_replay(1, steps)
+                total_steps += steps
+                budget -= steps * tc.batch_size
+                self.count += 1
+            else:
+                sleep(tc.poll_interval)
+            if time.time() - last_save >= tc.checkpoint_interval:
+                self.save_current_model(send=False)
+                self.replay.flush()
+                last_save = time.time()
+
+    def settled_play_data(self):
+        '''
+        the play data files that have not been written to for min_file_age seconds
+        '''
+        files = []
+        now = time.time()
+        for filename in get_game_data_filenames(self.config.resource):
+            try:
+                if now - os.path.getmtime(filename) > self.config.trainer.min_file_age:
+                    files.append(filename)
+            except OSError:
+                pass
+        return files
+
     def train_epoch(self, epochs):
         tc = self.config.trainer
+        if self.replay is not None:
+            return self.train_epoch_from_replay(epochs)
+        if tc.mirror_augment:
+            return self.train_epoch_mirrored(epochs)
         state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
+        weights = self.sample_weight()
+        if weights is not None:
+            weights = [weights, weights]    # of the policy and the value outputs
         tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
         if self.config.opts.use_multiple_gpus:
             self.mg_model.fit(state_ary, [policy_ary, value_ary],
@@ -115,6 +198,7 @@ class OptimizeWorker:
                                  epochs=epochs,
                                  shuffle=True,
                                  validation_split=0.02,
+                                 sample_weight=weights,
                                  callbacks=[tensorboard_cb])
         else:
             self.model.model.fit(state_ary, [policy_ary, value_ary],
@@ -122,10 +206,92 @@ class OptimizeWorker:
                                  epochs=epochs,
                                  shuffle=True,
                                  validation_split=0.02,
+                                 sample_weight=weights,
                                  callbacks=[tensorboard_cb])
         steps = (state_ary.shape[0] // tc.batch_size) * epochs
         return steps
 
+    def train_epoch_mirrored(self, epochs):
+        '''
+        the loaded dataset stays compact and half of every batch is mirrored left to right
+        '''
+        tc = self.config.trainer
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        state_ary = np.asarray(self.dataset[0], dtype=np.uint8)
+        policy_ary = np.asarray(self.dataset[1], dtype=np.float32)
+        value_ary = np.asarray(self.dataset[2], dtype=np.float32)
+        order = np.random.permutation(len(state_ary))
+        n_val = max(int(len(order) * 0.02), 1)
+        val, train = order[:n_val], order[n_val:]
+        steps = len(train) // tc.batch_size
+        if steps == 0:
+            return 0
+        weights = self.sample_weight()
+        validation_data = (fenv.compact_to_planes(state_ary[val]), [policy_ary[val], value_ary[val]])
+        if weights is not None:
+            validation_data += ([weights[val], weights[val]],)
+            weights = weights[train]
+        tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
+        model.fit_generator(array_batches(state_ary[train], policy_ary[train], value_ary[train], tc.batch_size,
+                                          mirror=True, weights=weights),
+                            steps_per_epoch=steps,
+                            epochs=epochs,
+                            validation_data=validation_data,
+                            callbacks=[tensorboard_cb])
+        return steps * epochs
+
+    def train_epoch_from_stream(self, epochs):
+        '''
+        train while self.filenames are still being read, an epoch is the estimated number of
+        samples in the files, at most dataset_size
+        '''
+        tc = self.config.trainer
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        stream = PlayDataStream(self.filenames, load_data_from_file, self.executor, tc.batch_size,
+                                tc.shuffle_buffer_size, prefetch=tc.cleaning_processes * 2,
+                                args=(self.config.opts.has_history,), mirror=tc.mirror_augment)
+        try:
+            planes, policy, value = stream.take(tc.batch_size, mirror=False)
+        except RuntimeError as e:
+            logger.info(f"{e}")
+            stream.close()
+            return 0
+        samples = min(stream.samples_per_file() * len(self.filenames), tc.dataset_size)
+        steps = int(samples) // tc.batch_size
+        if steps == 0:
+            stream.close()
+            return 0
+        logger.info(f"Streaming {len(self.filenames)} files, about {int(samples)} samples per epoch")
+        tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
+        try:
+            model.fit_generator(stream.batches(),
+                                steps_per_epoch=steps,
+                                epochs=epochs,
+                                validation_data=(planes, [policy, value]),
+                                callbacks=[tensorboard_cb])
+        finally:
+            stream.close()
+        return steps * epochs
+
+    def train_epoch_from_replay(self, epochs, steps=None):
+        tc = self.config.trainer
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        if steps is None:
+            steps = min(len(self.replay), tc.dataset_size) // tc.batch_size
+        validation = self.replay.validation_batch(tc.batch_size * 4)
+        if validation is not None:
+            planes, policy, value = validation
+            validation = (planes, [policy, value])
+        # the histograms need validation data
+        tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size,
+                                     histogram_freq=1 if validation is not None else 0)
+        model.fit_generator(self.replay.generator(tc.batch_size, mirror=tc.mirror_augment),
+                            steps_per_epoch=steps,
+                            epochs=epochs,
+                            validation_data=validation,
+                            callbacks=[tensorboard_cb])
+        return steps * epochs
+
     def compile_model(self):
         self.opt = SGD(lr=0.02, momentum=self.config.trainer.momentum)
         losses = ['categorical_crossentropy', 'mean_squared_error']
@@ -147,32 +313,68 @@ class OptimizeWorker:
             logger.debug(f"total step={total_steps}, set learning rate to {lr}")
 
     def fill_queue(self):
+        '''
+        load self.filenames into the dataset (or the replay buffer), returns the number of samples loaded
+        '''
         futures = deque()
         n = len(self.filenames)
-        with ProcessPoolExecutor(max_workers=self.config.trainer.cleaning_processes) as executor:
-            for _ in range(self.config.trainer.cleaning_processes):
-                if len(self.filenames) == 0:
-                    break
+        loaded = 0
+        executor = self.executor
+        for _ in range(self.config.trainer.cleaning_processes):
+            if len(self.filenames) == 0:
+                break
+            filename = self.filenames.pop()
+            # logger.debug("loading data from %s" % (filename))
+            futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
+        while futures and (self.replay is not None or len(self.dataset[0]) < self.config.trainer.dataset_size): #fill tuples
+            _tuple = futures.popleft().result()
+            if _tuple is not None:
+                loaded += len(_tuple[0])
+                if self.replay is not None:
+                    self.replay.add(*_tuple)
+                else:
+                    for x, y in zip(self.dataset, _tuple):
+                        x.extend(y)
+            m = len(self.filenames)
+            if m > 0:
+                if (n - m) % 1000 == 0:
+                    logger.info(f"Reading {n - m} files")
                 filename = self.filenames.pop()
                 # logger.debug("loading data from %s" % (filename))
                 futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
-            while futures and len(self.dataset[0]) < self.config.trainer.dataset_size: #fill tuples
-                _tuple = futures.popleft().result()
-                if _tuple is not None:
-                    for x, y in zip(self.dataset, _tuple):
-                        x.extend(y)
-                m = len(self.filenames)
-                if m > 0:
-                    if (n - m) % 1000 == 0:
-                        logger.info(f"Reading {n - m} files")
-                    filename = self.filenames.pop()
-                    # logger.debug("loading data from %s" % (filename))
-                    futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
+        for future in futures:
+            future.cancel()
+        return loaded
+
+    def dedup_dataset(self):
+        '''
+        merge the rows of identical positions, rows merged in an earlier round count for their samples
+        '''
+        counts = self.counts
+        if counts is not None:
+            # the rows loaded since then are one sample each
+            counts = np.concatenate([counts, np.ones(len(self.dataset[0]) - len(counts), dtype=np.float32)])
+        state_ary, policy_ary, value_ary, self.counts = dedup_samples(*self.dataset, counts=counts)
+        self.dataset = deque(state_ary), deque(policy_ary), deque(value_ary)
+        positions = len(state_ary)
+        if positions > 0:
+            n = int(self.counts.sum())
+            logger.info(f"Dedup {n} samples to {positions} positions ({n / positions:.2f}x), "
+                        f"weight cap {self.config.trainer.dedup_cap}")
+
+    def sample_weight(self):
+        '''
+        the training weights of the dataset rows, None when they are not merged
+        '''
+        if self.counts is None:
+            return None
+        return sample_weights(self.counts, self.config.trainer.dedup_cap)
 
     def collect_all_loaded_data(self):
         state_ary, policy_ary, value_ary = self.dataset
 
-        state_ary1 = np.asarray(state_ary, dtype=np.float32)
+        # the states are kept in their compact form until here
+        state_ary1 = fenv.compact_to_planes(np.asarray(state_ary, dtype=np.uint8))
         policy_ary1 = np.asarray(policy_ary, dtype=np.float32)
         value_ary1 = np.asarray(value_ary, dtype=np.float32)
         return state_ary1, policy_ary1, value_ary1
@@ -222,40 +424,68 @@ class OptimizeWorker:
 
 def load_data_from_file(filename, use_history=False):
     try:
-        data = read_game_data_from_file(filename)
+        games = read_games_from_file(filename)
     except Exception as e:
         logger.error(f"Error when loading data {e}")
-        os.remove(filename)
+        if os.path.exists(filename):
+            os.remove(filename)
         return None
-    if data is None:
+    if not games:
         return None
-    return expanding_data(data, use_history)
+    return expand_games(games, use_history)
 
 def expanding_data(data, use_history=False):
-    state = data[0]
-    real_data = []
-    action = None
-    policy = None
-    value = None
-    if use_history:
-        history = [state]
-    else:
-        history = None
-    for item in data[1:]:
-        action = item[0]
-        value = item[1]
+    return expand_games([data], use_history)
+
+def expand_games(games, use_history=False):
+    '''
+    replay games ([init_state, [action, value, visits], ...] each) into preallocated arrays:
+    compact states (n, 90 or 180), policies (n, labels_n) and values (n,)
+    '''
+    n = sum(len(data) - 1 for data in games)
+    width = fenv.BOARD_SIZE * (2 if use_history else 1)
+    states = np.zeros((n, width), dtype=np.uint8)
+    policies = np.zeros((n, len(ActionLabelsRed)), dtype=np.float32)
+    values = np.zeros(n, dtype=np.float32)
+    rows, idx, cnt = [], [], []
+    r = 0
+    for data in games:
+        start = r
+        compacts = []
+        game_rows, game_idx, game_cnt = [], [], []
         try:
-            policy = build_policy(action, flip=False)
+            pos = fenv.Position(data[0])
+            for item in data[1:]:
+                compacts.append(pos.compact())
+                if len(item) > 2 and item[2]:
+                    # sparse visit counts of the search
+                    for i, c in item[2]:
+                        game_rows.append(r)
+                        game_idx.append(i)
+                        game_cnt.append(c)
+                else:
+                    game_rows.append(r)
+                    game_idx.append(Move_2_Idx[item[0]])
+                    game_cnt.append(1)
+                values[r] = item[1]
+                pos.make(item[0])
+                r += 1
         except Exception as e:
-            logger.error(f"Expand data error {e}, item = {item}, data = {data}, state = {state}")
-            return None
-        real_data.append([state, policy, value])
-        state = senv.step(state, action)
+            logger.error(f"Expand data error {e}, data = {data}")
+            r = start
+            continue
+        if r == start:
+            continue
+        states[start:r, :fenv.BOARD_SIZE] = np.frombuffer(b''.join(compacts), dtype=np.uint8).reshape(-1, fenv.BOARD_SIZE)
         if use_history:
-            history.append(action)
-            history.append(state)
-        
-    return convert_to_trainging_data(real_data, history)
+            # the position before the last two moves, an empty board for the first two
+            states[start + 2:r, fenv.BOARD_SIZE:] = states[start:r - 2, :fenv.BOARD_SIZE]
+        rows += game_rows
+        idx += game_idx
+        cnt += game_cnt
+    policies[rows, idx] = cnt
+    policies /= np.maximum(policies.sum(axis=1, keepdims=True), 1)
+    return states[:r], policies[:r], values[:r]
 
 
 def convert_to_trainging_data(data, history):
@@ -266,9 +496,9 @@ def convert_to_trainging_data(data, history):
 
     for state, policy, value in data:
         if history is None:
-            state_planes = senv.state_to_planes(state)
+            state_planes = fenv.state_to_compact(state)
         else:
-            state_planes = senv.state_history_to_planes(state, history[0:i * 2 + 1])
+            state_planes = fenv.state_history_to_compact(state, history[0:i * 2 + 1])
         sl_value = value
 
         state_list.append(state_planes)
@@ -276,20 +506,16 @@ def convert_to_trainging_data(data, history):
         value_list.append(sl_value)
         i += 1
 
-    return np.asarray(state_list, dtype=np.float32), \
+    return fenv.compact_array(state_list), \
            np.asarray(policy_list, dtype=np.float32), \
            np.asarray(value_list, dtype=np.float32)
 
-def build_policy(action, flip):
-    labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-    policy = np.zeros(labels_n)
-
-    policy[move_lookup[action]] = 1
-
-    if flip:
-        policy = flip_policy(policy)
-    return list(policy)
-
-
-
+def build_visit_policy(visits):
+    '''
+    policy from [[index in ActionLabelsRed, visit count], ...]
+    '''
+    policy = np.zeros(len(ActionLabelsRed))
+    idx, n = zip(*visits)
+    policy[list(idx)] = n
+    policy /= policy.sum()
+    return policy
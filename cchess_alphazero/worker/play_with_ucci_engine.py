@@ -14,11 +14,11 @@ from random import random
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, build_policy, flip_move
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
 from cchess_alphazero.lib.model_helper import load_best_model_weight, save_as_best_model
 from cchess_alphazero.lib.tf_util import set_session_config
@@ -64,7 +64,7 @@ class SelfPlayWorker:
         self.buffer = []
 
         while True:
-            search_tree = defaultdict(VisitState)
+            search_tree = new_search_tree(self.config)
             start_time = time()
             value, turns, state, store = self.start_game(idx, search_tree)
             end_time = time()
@@ -87,7 +87,7 @@ class SelfPlayWorker:
 
         if not self.config.play.share_mtcs_info_in_self_play or \
             idx % self.config.play.reset_mtcs_info_per_game == 0:
-            search_tree = defaultdict(VisitState)
+            search_tree = new_search_tree(self.config)
 
         if random() > self.config.play.enable_resign_rate:
             enable_resign = True
@@ -223,13 +223,5 @@ class SelfPlayWorker:
             pass
 
     def build_policy(self, action, flip):
-        labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-        policy = np.zeros(labels_n)
-
-        policy[move_lookup[action]] = 1
-
-        if flip:
-            policy = flip_policy(policy)
-        return list(policy)
+        return list(build_policy(action, flip))
 
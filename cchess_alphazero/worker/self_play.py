@@ -13,13 +13,16 @@ from random import random
 from threading import Thread
 
 import cchess_alphazero.environment.static_env as senv
+import cchess_alphazero.environment.fast_env as fenv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, BatchPlayer, new_search_tree, new_eval_cache
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, build_policy, flip_move, Move_2_Idx
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from cchess_alphazero.lib.chunk_helper import ChunkWriter, split_games, finish_part_files
+from cchess_alphazero.lib.shm_helper import SharedEvalCache, shared_memory
 from cchess_alphazero.lib.model_helper import load_model_weight, save_as_best_model, load_best_model_weight_from_internet
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import upload_file
@@ -48,26 +51,157 @@ def load_model(config, config_file=None):
 def start(config: Config):
     set_session_config(per_process_gpu_memory_fraction=1, allow_growth=True, device_list=config.opts.device_list)
     current_model, use_history = load_model(config)
+    finish_part_files(config.resource.play_data_dir)
+    if config.play.parallel_games > 0:
+        return BatchedSelfPlayWorker(config, current_model, use_history).start()
     m = Manager()
     cur_pipes = m.list([current_model.get_pipes() for _ in range(config.play.max_processes)])
+    # the players check their evaluation cache against the weights the model API has loaded
+    model_digest = m.Value('s', current_model.digest)
+    current_model.api.digest_value = model_digest
+    current_model.api.publish_digest()
+    eval_cache = None
+    if config.play.eval_cache_size > 0 and config.play.eval_cache_shared:
+        if shared_memory is None:
+            logger.warning("eval_cache_shared needs multiprocessing.shared_memory (python 3.8+), use a cache per process")
+        else:
+            eval_cache = SharedEvalCache(config.play.eval_cache_size)
+            eval_cache.check_model(current_model.digest)
     # play_worker = SelfPlayWorker(config, cur_pipes, 0)
     # play_worker.start()
-    with ProcessPoolExecutor(max_workers=config.play.max_processes) as executor:
-        futures = []
-        for i in range(config.play.max_processes):
-            play_worker = SelfPlayWorker(config, cur_pipes, i, use_history)
-            logger.debug("Initialize selfplay worker")
-            futures.append(executor.submit(play_worker.start))
+    try:
+        with ProcessPoolExecutor(max_workers=config.play.max_processes) as executor:
+            futures = []
+            for i in range(config.play.max_processes):
+                play_worker = SelfPlayWorker(config, cur_pipes, i, use_history, eval_cache, model_digest)
+                logger.debug("Initialize selfplay worker")
+                futures.append(executor.submit(play_worker.start))
+    finally:
+        if eval_cache is not None:
+            eval_cache.close()
+
+class SelfPlayGame:
+    '''
+    The rules of a self-play game: the moves played, the draws by no capture, lack of
+    attacking pieces and repetition, the moves forbidden by repetition, and its play data
+    '''
+    def __init__(self, config: Config):
+        self.config = config
+        self.pos = fenv.Position()
+        self.state = self.pos.state()
+        self.history = [self.state]
+        self.keys = [self.pos.key]  # zobrist key of history[2 * i]
+        self.policys = []           # sparse visit counts of each move
+        self.value = 0
+        self.turns = 0              # even == red; odd == black
+        self.game_over = False
+        self.final_move = None
+        self.no_eat_count = 0
+        self.check = False
+        self.no_act = []
+        self.increase_temp = False
+
+    def resign(self):
+        self.value = -1
+        self.game_over = True
+
+    def play(self, action, player, policy=None):
+        '''
+        play the action chosen by player, whose root visit counts are recorded, and check the game end
+        '''
+        pos = self.pos
+        self.history.append(action)
+        self.policys.append(player.visit_counts(self.state, self.no_act))
+        try:
+            no_eat = pos.make(action) == fenv.EMPTY
+        except Exception as e:
+            logger.error(f"{e}, no_act = {self.no_act}, policy = {policy}")
+            self.game_over = True
+            self.value = 0
+            return
+        self.turns += 1
+        if no_eat:
+            self.no_eat_count += 1
+        else:
+            self.no_eat_count = 0
+        self.state = state = pos.state()
+        key = pos.key
+        self.history.append(state)
+        self.keys.append(key)
+
+        if self.no_eat_count >= 120 or self.turns / 2 >= self.config.play.max_game_length:
+            self.game_over = True
+            self.value = 0
+        else:
+            self.game_over, self.value, self.final_move, self.check = player.position_status(pos)
+            if not self.game_over:
+                if not senv.has_attack_chessman(state):
+                    logger.info(f"双方无进攻子力，作和。state = {state}")
+                    self.game_over = True
+                    self.value = 0
+            self.increase_temp = False
+            self.no_act = []
+            if not self.game_over and not self.check and key in self.keys[:-1]:
+                free_move = defaultdict(int)
+                for i in range(len(self.keys) - 1):
+                    if self.keys[i] == key:
+                        act = self.history[i * 2 + 1]
+                        if pos.will_check_or_catch(act):
+                            self.no_act.append(act)
+                        elif not pos.be_catched(act):
+                            self.increase_temp = True
+                            free_move[key] += 1
+                            if free_move[key] >= 3:
+                                # 作和棋处理
+                                self.game_over = True
+                                self.value = 0
+                                logger.info("闲着循环三次，作和棋处理")
+                                break
+
+    def finish(self):
+        '''
+        play the final move, if any, and return the result, 1 = red wins, -1 = black wins, 0 draw
+        '''
+        if self.final_move:
+            # policy = self.build_policy(final_move, False)
+            self.history.append(self.final_move)
+            self.policys.append([[Move_2_Idx[self.final_move], 1]])
+            self.pos.make(self.final_move)
+            self.state = self.pos.state()
+            self.turns += 1
+            self.value = -self.value
+            self.history.append(self.state)
+            self.final_move = None
+        if self.turns % 2 == 1:  # balck turn
+            self.value = -self.value
+        return self.value
+
+    def play_data(self):
+        '''
+        [init_state, [action, value, visits], ...], the value is from the side to move
+        '''
+        value = self.value
+        data = [self.history[0]]
+        for i in range(self.turns):
+            k = i * 2
+            data.append([self.history[k + 1], value, self.policys[i]])
+            value = -value
+        return data
+
 
 class SelfPlayWorker:
-    def __init__(self, config: Config, pipes=None, pid=None, use_history=False):
+    def __init__(self, config: Config, pipes=None, pid=None, use_history=False, eval_cache=None, model_digest=None):
         self.config = config
         self.player = None
+        self.eval_cache = eval_cache    # shared by the processes, else each process makes its own in start
+        self.model_digest = model_digest    # Manager Value of the digest of the weights the model API uses
         self.cur_pipes = pipes
         self.id = pid
         self.buffer = []
         self.pid = os.getpid()
         self.use_history = use_history
+        self.use_chunk = config.play_data.data_format == 'chunk' and not config.internet.distributed
+        self.chunk_writer = ChunkWriter(config.play_data.chunks_per_file)
 
     def start(self):
         self.pid = os.getpid()
@@ -77,15 +211,19 @@ class SelfPlayWorker:
 
         idx = 1
         self.buffer = []
-        search_tree = defaultdict(VisitState)
+        search_tree = new_search_tree(self.config)
+        if self.eval_cache is None:
+            self.eval_cache = new_eval_cache(self.config, self.model_digest.value)
 
         while True:
             start_time = time()
-            search_tree = defaultdict(VisitState)
+            search_tree = new_search_tree(self.config)
             value, turns, state, store = self.start_game(idx, search_tree)
             end_time = time()
             logger.debug(f"Process {self.pid}-{self.id} play game {idx} time={(end_time - start_time):.1f} sec, "
                          f"turn={turns / 2}, winner = {value:.2f} (1 = red, -1 = black, 0 draw)")
+            if self.eval_cache is not None:
+                logger.debug(f"Process {self.pid}-{self.id} eval cache: {self.eval_cache.stats()}")
             if turns <= 10:
                 senv.render(state)
             if store:
@@ -97,7 +235,7 @@ class SelfPlayWorker:
 
         if not self.config.play.share_mtcs_info_in_self_play or \
             idx % self.config.play.reset_mtcs_info_per_game == 0:
-            search_tree = defaultdict(VisitState)
+            search_tree = new_search_tree(self.config)
 
         if random() > self.config.play.enable_resign_rate:
             enable_resign = True
@@ -105,93 +243,37 @@ class SelfPlayWorker:
             enable_resign = False
 
         self.player = CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, 
-                                    enable_resign=enable_resign, debugging=False, use_history=self.use_history)
-
-        state = senv.INIT_STATE
-        history = [state]
-        # policys = [] 
-        value = 0
-        turns = 0       # even == red; odd == black
-        game_over = False
-        final_move = None
-        no_eat_count = 0
-        check = False
-        no_act = []
-        increase_temp = False
-
-        while not game_over:
-            start_time = time()
-            action, policy = self.player.action(state, turns, no_act, increase_temp=increase_temp)
-            end_time = time()
+                                    enable_resign=enable_resign, debugging=False, use_history=self.use_history,
+                                    eval_cache=self.eval_cache)
+
+        game = SelfPlayGame(self.config)
+        while not game.game_over:
+            if self.eval_cache is not None:
+                self.eval_cache.check_model(self.model_digest.value)
+            action, policy = self.player.action(game.state, game.turns, game.no_act, increase_temp=game.increase_temp)
             if action is None:
-                logger.debug(f"{turns % 2} (0 = red; 1 = black) has resigned!")
-                value = -1
+                logger.debug(f"{game.turns % 2} (0 = red; 1 = black) has resigned!")
+                game.resign()
                 break
             # if self.config.opts.log_move:
             #     logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
-            # logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
-            history.append(action)
-            # policys.append(policy)
-            try:
-                state, no_eat = senv.new_step(state, action)
-            except Exception as e:
-                logger.error(f"{e}, no_act = {no_act}, policy = {policy}")
-                game_over = True
-                value = 0
-                break
-            turns += 1
-            if no_eat:
-                no_eat_count += 1
-            else:
-                no_eat_count = 0
-            history.append(state)
-
-            if no_eat_count >= 120 or turns / 2 >= self.config.play.max_game_length:
-                game_over = True
-                value = 0
-            else:
-                game_over, value, final_move, check = senv.done(state, need_check=True)
-                if not game_over:
-                    if not senv.has_attack_chessman(state):
-                        logger.info(f"双方无进攻子力，作和。state = {state}")
-                        game_over = True
-                        value = 0
-                increase_temp = False
-                no_act = []
-                if not game_over and not check and state in history[:-1]:
-                    free_move = defaultdict(int)
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            if senv.will_check_or_catch(state, history[i+1]):
-                                no_act.append(history[i + 1])
-                            elif not senv.be_catched(state, history[i+1]):
-                                increase_temp = True
-                                free_move[state] += 1
-                                if free_move[state] >= 3:
-                                    # 作和棋处理
-                                    game_over = True
-                                    value = 0
-                                    logger.info("闲着循环三次，作和棋处理")
-                                    break
-
-        if final_move:
-            # policy = self.build_policy(final_move, False)
-            history.append(final_move)
-            # policys.append(policy)
-            state = senv.step(state, final_move)
-            turns += 1
-            value = -value
-            history.append(state)
+            game.play(action, self.player, policy)
 
         self.player.close()
         del search_tree
         del self.player
         gc.collect()
-        if turns % 2 == 1:  # balck turn
-            value = -value
+        v, turns, state, store = self.finish_game(idx, game)
+        self.cur_pipes.append(pipes)
+        self.remove_play_data()
+        return v, turns, state, store
 
-        v = value
-        if turns < 10:
+    def finish_game(self, idx, game):
+        '''
+        save the play data of a finished game, most of the games shorter than 10 turns are dropped
+        '''
+        v = game.finish()
+        if game.turns < 10:
             if random() > 0.9:
                 store = True
             else:
@@ -200,16 +282,8 @@ class SelfPlayWorker:
             store = True
 
         if store:
-            data = [history[0]]
-            for i in range(turns):
-                k = i * 2
-                data.append([history[k + 1], value])
-                value = -value
-            self.save_play_data(idx, data)
-
-        self.cur_pipes.append(pipes)
-        self.remove_play_data()
-        return v, turns, state, store
+            self.save_play_data(idx, game.play_data())
+        return v, game.turns, game.state, store
 
     def save_play_data(self, idx, data):
         self.buffer += data
@@ -221,6 +295,13 @@ class SelfPlayWorker:
         utc_dt = datetime.utcnow().replace(tzinfo=timezone.utc)
         bj_dt = utc_dt.astimezone(timezone(timedelta(hours=8)))
         game_id = bj_dt.strftime("%Y%m%d-%H%M%S.%f")
+        if self.use_chunk:
+            path = os.path.join(rc.play_data_dir, rc.play_data_chunk_filename_tmpl % game_id)
+            path = self.chunk_writer.write(path, split_games(self.buffer))
+            if path:
+                logger.info(f"Process {self.pid} save play data to {path}")
+            self.buffer = []
+            return
         filename = rc.play_data_filename_tmpl % game_id
         path = os.path.join(rc.play_data_dir, filename)
         logger.info(f"Process {self.pid} save play data to {path}")
@@ -251,13 +332,98 @@ class SelfPlayWorker:
             pass
 
     def build_policy(self, action, flip):
-        labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-        policy = np.zeros(labels_n)
+        return list(build_policy(action, flip))
+
+
+class BatchedSelfPlayWorker(SelfPlayWorker):
+    '''
+    Plays config.play.parallel_games games at once in this process, without threads nor pipes:
+    every step collects up to search_threads leaves of each game (the same width the virtual
+    loss gives a threaded player), evaluates all of them in one batch with the model of this
+    process, backs the results up, and plays a move in the games whose search is done.
+    A finished game is replaced by a new one.
+    '''
+    def __init__(self, config: Config, model, use_history=False):
+        super().__init__(config, use_history=use_history)
+        self.model = model
+        self.api = CChessModelAPI(config, model)    # for the model reloading and the batch stats
+        self.games = []     # [SelfPlayGame, BatchPlayer, start time]
+        self.idx = 1
+
+    def start(self):
+        pc = self.config.play
+        logger.info(f"Selfplay#Start {pc.parallel_games} games in process {self.pid}")
+        self.eval_cache = new_eval_cache(self.config, self.model.digest)
+        self.games = [self.new_game() for _ in range(pc.parallel_games)]
+        last_model_check_time = time()
+        last_stats_time = time()
+        while True:
+            if last_model_check_time + 600 < time():
+                self.api.try_reload_model()
+                if self.eval_cache is not None:
+                    self.eval_cache.check_model(self.model.digest)
+                last_model_check_time = time()
+            if pc.batch_stats_interval and last_stats_time + pc.batch_stats_interval < time():
+                self.api.log_batch_stats()
+                if self.eval_cache is not None:
+                    logger.info(f"Eval cache: {self.eval_cache.stats()}")
+                last_stats_time = time()
+            self.step()
 
-        policy[move_lookup[action]] = 1
+    def new_game(self):
+        enable_resign = random() > self.config.play.enable_resign_rate
+        game = SelfPlayGame(self.config)
+        player = BatchPlayer(self.config, enable_resign=enable_resign, use_history=self.use_history,
+                             eval_cache=self.eval_cache)
+        player.start_search(game.state, game.turns, game.no_act, game.increase_temp)
+        return [game, player, time()]
 
-        if flip:
-            policy = flip_policy(policy)
-        return list(policy)
+    def step(self):
+        planes, owners = [], []
+        for i, (_, player, _) in enumerate(self.games):
+            for state_planes, history in player.collect_leaves(self.config.play.search_threads):
+                planes.append(state_planes)
+                owners.append((i, history))
+        if planes:
+            policy_ary, value_ary = self.predict(planes)
+            for (i, history), p, v in zip(owners, policy_ary, value_ary):
+                self.games[i][1].backup(p, float(v), history)
+        for i, (game, player, start_time) in enumerate(self.games):
+            if player.search_done():
+                self.play_move(game, player)
+                if game.game_over:
+                    self.end_game(game, start_time)
+                    self.games[i] = self.new_game()
+
+    def predict(self, planes):
+        pc = self.config.play
+        data = fenv.compact_to_planes(fenv.compact_array(planes))
+        policy_ary, value_ary = [], []
+        with self.model.graph.as_default():
+            for i in range(0, len(data), pc.batch_max):
+                p, v = self.model.model.predict_on_batch(data[i:i + pc.batch_max])
+                policy_ary.append(p)
+                value_ary.append(v)
+        self.api.record_batch(len(data), 0)
+        return np.concatenate(policy_ary), np.concatenate(value_ary).reshape(-1)
+
+    def play_move(self, game, player):
+        action, policy = player.choose_action(game.state, game.turns, game.no_act)
+        if action is None:
+            logger.debug(f"{game.turns % 2} (0 = red; 1 = black) has resigned!")
+            game.resign()
+            return
+        game.play(action, player, policy)
+        if not game.game_over:
+            player.start_search(game.state, game.turns, game.no_act, game.increase_temp)
+
+    def end_game(self, game, start_time):
+        value, turns, state, store = self.finish_game(self.idx, game)
+        logger.debug(f"Process {self.pid} play game {self.idx} time={(time() - start_time):.1f} sec, "
+                     f"turn={turns / 2}, winner = {value:.2f} (1 = red, -1 = black, 0 draw)")
+        if turns <= 10:
+            senv.render(state)
+        if store:
+            self.idx += 1
+            self.remove_play_data()
 
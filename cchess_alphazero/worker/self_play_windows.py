@@ -15,12 +15,13 @@ from random import random
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, new_search_tree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, build_policy, flip_move, Move_2_Idx
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from cchess_alphazero.lib.chunk_helper import ChunkWriter, split_games, finish_part_files
 from cchess_alphazero.lib.model_helper import load_model_weight, save_as_best_model, load_best_model_weight_from_internet
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import upload_file
@@ -46,6 +47,9 @@ class SelfPlayWorker:
         self.current_model, self.use_history = self.load_model()
         self.m = Manager()
         self.cur_pipes = self.m.list([self.current_model.get_pipes() for _ in range(self.config.play.max_processes)])
+        self.use_chunk = config.play_data.data_format == 'chunk' and not config.internet.distributed
+        self.chunk_writer = ChunkWriter(config.play_data.chunks_per_file)
+        finish_part_files(config.resource.play_data_dir)
 
     def start(self):
         global job_done
@@ -114,6 +118,13 @@ class SelfPlayWorker:
     def flush_buffer(self):
         rc = self.config.resource
         game_id = datetime.now().strftime("%Y%m%d-%H%M%S.%f")
+        if self.use_chunk:
+            path = os.path.join(rc.play_data_dir, rc.play_data_chunk_filename_tmpl % game_id)
+            path = self.chunk_writer.write(path, split_games(self.buffer))
+            if path:
+                logger.info("保存博弈数据到 %s" % (path))
+            self.buffer = []
+            return
         filename = rc.play_data_filename_tmpl % game_id
         path = os.path.join(rc.play_data_dir, filename)
         logger.info("保存博弈数据到 %s" % (path))
@@ -162,12 +173,12 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
     else:
         enable_resign = False
 
-    player = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe, 
+    player = CChessPlayer(config, search_tree=new_search_tree(config), pipes=pipe, 
                             enable_resign=enable_resign, debugging=False, use_history=use_history)
 
     state = senv.INIT_STATE
     history = [state]
-    # policys = [] 
+    policys = []    # sparse visit counts of each move
     value = 0
     turns = 0
     game_over = False
@@ -186,7 +197,7 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
             value = -1
             break
         print(f"博弈中: 回合{turns / 2 + 1} {'红方走棋' if turns % 2 == 0 else '黑方走棋'}, 着法: {action}, 用时: {(end_time - start_time):.1f}s")
-        # policys.append(policy)
+        policys.append(player.visit_counts(state, no_act))
         history.append(action)
         try:
             state, no_eat = senv.new_step(state, action)
@@ -233,7 +244,7 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
     if final_move:
         # policy = build_policy(final_move, False)
         history.append(final_move)
-        # policys.append(policy)
+        policys.append([[Move_2_Idx[final_move], 1]])
         state = senv.step(state, final_move)
         turns += 1
         value = -value
@@ -250,19 +261,8 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
     data = [history[0]]
     for i in range(turns):
         k = i * 2
-        data.append([history[k + 1], value])
+        data.append([history[k + 1], value, policys[i]])
         value = -value
 
     cur.append(pipe)
     return (turns, v), data
-
-def build_policy(action, flip):
-    labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-    policy = np.zeros(labels_n)
-
-    policy[move_lookup[action]] = 1
-
-    if flip:
-        policy = flip_policy(policy)
-    return list(policy)
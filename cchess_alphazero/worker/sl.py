@@ -15,7 +15,8 @@ from cchess_alphazero.config import Config
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
 from cchess_alphazero.lib.model_helper import load_sl_best_model_weight, save_as_sl_best_model
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, flip_move
+import cchess_alphazero.environment.fast_env as fenv
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, flip_move, Move_2_Idx, Unflipped_index
 from cchess_alphazero.lib.tf_util import set_session_config
 
 from keras.optimizers import Adam
@@ -37,24 +38,22 @@ class SupervisedWorker:
         self.filenames = []
         self.opt = None
         self.buffer = []
-        self.gameinfo = None
-        self.moves = None
+        self.encoded = None
         self.config.opts.light = True
 
     def start(self):
         self.model = self.load_model()
-        self.gameinfo = pd.read_csv(self.config.resource.sl_data_gameinfo)
-        self.moves = pd.read_csv(self.config.resource.sl_data_move)
+        self.encoded = self.load_encoded_data()
         self.training()
 
     def training(self):
         self.compile_model()
         total_steps = self.config.trainer.start_total_steps
-        logger.info(f"Start training, game count = {len(self.gameinfo)}, step = {self.config.trainer.sl_game_step} games")
+        n_games = len(self.encoded['offsets']) - 1
+        logger.info(f"Start training, game count = {n_games}, step = {self.config.trainer.sl_game_step} games")
 
-        for i in range(0, len(self.gameinfo), self.config.trainer.sl_game_step):
-            games = self.gameinfo[i:i+self.config.trainer.sl_game_step]
-            self.fill_queue(games)
+        for i in range(0, n_games, self.config.trainer.sl_game_step):
+            self.fill_queue(i, min(i + self.config.trainer.sl_game_step, n_games))
             if len(self.dataset[0]) > self.config.trainer.batch_size:
                 steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
                 total_steps += steps
@@ -82,20 +81,43 @@ class SupervisedWorker:
         losses = ['categorical_crossentropy', 'mean_squared_error'] # avoid overfit for supervised 
         self.model.model.compile(optimizer=self.opt, loss=losses, loss_weights=self.config.trainer.loss_weights)
 
-    def fill_queue(self, games):
-        _tuple = self.generate_game_data(games)
-        if _tuple is not None:
-            for x, y in zip(self.dataset, _tuple):
-                x.extend(y)
+    def fill_queue(self, first, last):
+        '''
+        the samples of the games first..last-1 of the encoded dataset
+        '''
+        offsets = self.encoded['offsets']
+        rows = slice(offsets[first], offsets[last])
+        for x, y in zip(self.dataset, (self.encoded['states'][rows], self.encoded['policies'][rows],
+                                       self.encoded['values'][rows])):
+            x.extend(y)
 
     def collect_all_loaded_data(self):
         state_ary, policy_ary, value_ary = self.dataset
 
-        state_ary1 = np.asarray(state_ary, dtype=np.float32)
-        policy_ary1 = np.asarray(policy_ary, dtype=np.float32)
+        # states are compact and policies are indexes in ActionLabelsRed until here
+        state_ary1 = fenv.compact_to_planes(np.asarray(state_ary, dtype=np.uint8))
+        policy_ary1 = np.zeros((len(policy_ary), len(ActionLabelsRed)), dtype=np.float32)
+        policy_ary1[np.arange(len(policy_ary)), np.asarray(policy_ary, dtype=np.int64)] = 1
         value_ary1 = np.asarray(value_ary, dtype=np.float32)
         return state_ary1, policy_ary1, value_ary1
 
+    def load_encoded_data(self):
+        '''
+        the encoded dataset, read from the cache when it is newer than the csv files
+        '''
+        rc = self.config.resource
+        csv_mtime = max(os.path.getmtime(rc.sl_data_gameinfo), os.path.getmtime(rc.sl_data_move))
+        if os.path.exists(rc.sl_data_cache) and os.path.getmtime(rc.sl_data_cache) > csv_mtime:
+            logger.info(f"Load encoded sl data from {rc.sl_data_cache}")
+            with np.load(rc.sl_data_cache) as f:
+                return {k: f[k] for k in f.files}
+        start_time = time()
+        encoded = encode_sl_data(self.config, rc.sl_data_gameinfo, rc.sl_data_move)
+        np.savez(rc.sl_data_cache, **encoded)
+        logger.info(f"Encoded {len(encoded['offsets']) - 1} games, {len(encoded['values'])} positions "
+                    f"in {time() - start_time:.1f}s, saved to {rc.sl_data_cache}")
+        return encoded
+
     def load_model(self):
         model = CChessModel(self.config)
         if self.config.opts.new or not load_sl_best_model_weight(model):
@@ -107,101 +129,104 @@ class SupervisedWorker:
         logger.debug("Save best sl model")
         save_as_sl_best_model(self.model)
 
-    def generate_game_data(self, games):
-        self.buffer = []
-        start_time = time()
-        for idx, game in games.iterrows():
-            gid = game['gameID']
-            winner = game['winner']
-            move = self.moves[self.moves.gameID == gid]
-            red = move[move.side == 'red']
-            black = move[move.side == 'black']
-            self.load_game(red, black, winner, idx)
-        end_time = time()
-        logger.debug(f"Loading {len(games)} games, time: {end_time - start_time}s")
-        return self.convert_to_trainging_data()
-
-    def load_game(self, red, black, winner, idx):
-        env = CChessEnv(self.config).reset()
-        red_moves = []
-        black_moves = []
-        turns = 1
-        black_max_turn = black['turn'].max()
-        red_max_turn = red['turn'].max()
-
+def encode_sl_data(config, gameinfo_path, moves_path):
+    '''
+    encode the csv games: the moves are grouped by game once and the games are replayed in a process pool
+    returns compact states, policy indexes and values of all positions, and the offset of the first
+    position of every game (plus the total) in the order of gameinfo
+    '''
+    gameinfo = pd.read_csv(gameinfo_path)
+    moves = pd.read_csv(moves_path)
+    moves_of = {}
+    for (gid, side), group in moves.groupby(['gameID', 'side'], sort=False):
+        moves_of[(gid, side)] = dict(zip(group['turn'], group['move']))
+    games = [(moves_of.get((gid, 'red'), {}), moves_of.get((gid, 'black'), {}), winner)
+             for gid, winner in zip(gameinfo['gameID'], gameinfo['winner'])]
+    del moves, moves_of
+    chunk = 500
+    tasks = [games[i:i + chunk] for i in range(0, len(games), chunk)]
+    states, policies, values, lengths = [], [], [], []
+    skipped_games = skipped_moves = 0
+    with ProcessPoolExecutor(max_workers=config.trainer.cleaning_processes) as executor:
+        for result in executor.map(encode_sl_games, [config] * len(tasks), tasks):
+            for game in result:
+                if game is None:
+                    skipped_games += 1
+                    lengths.append(0)
+                    continue
+                s, p, v, skipped = game
+                states += s
+                policies += p
+                values += v
+                lengths.append(len(v))
+                skipped_moves += skipped
+    if skipped_games or skipped_moves:
+        logger.info(f"Skipped {skipped_games} unreadable games and {skipped_moves} unknown moves "
+                    f"of {len(games)} games in {moves_path}")
+    return {'states': fenv.compact_array(states),
+            'policies': np.asarray(policies, dtype=np.int16),
+            'values': np.asarray(values, dtype=np.int8),
+            'offsets': np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])}
+
+def encode_sl_games(config, games):
+    return [encode_sl_game(config, red, black, winner) for red, black, winner in games]
+
+def encode_sl_game(config, red, black, winner):
+    '''
+    red / black: {turn: WXF move}, returns the compact states, policy indexes and values
+    of the positions in the order they were played, and the number of moves left out because
+    they are not in ActionLabelsRed. None when the game cannot be replayed
+    '''
+    env = CChessEnv(config).reset()
+    red_moves = []
+    black_moves = []
+    turns = 1
+    red_max_turn = max(red) if red else 0
+    black_max_turn = max(black) if black else 0
+    skipped = 0
+
+    try:
         while turns < black_max_turn or turns < red_max_turn:
             if turns < red_max_turn:
-                wxf_move = red[red.turn == turns]['move'].item()
-                action = env.board.parse_WXF_move(wxf_move)
-                try:
-                    red_moves.append([env.observation, self.build_policy(action, flip=False)])
-                except Exception as e:
-                    for i in range(10):
-                        logger.debug(f"{env.board.screen[i]}")
-                    logger.debug(f"{turns} {wxf_move} {action}")
-                
+                action = env.board.parse_WXF_move(red[turns])
+                if action in Move_2_Idx:
+                    red_moves.append([fenv.state_to_compact(env.observation), Move_2_Idx[action]])
+                else:
+                    logger.debug(f"Skip move at turn {turns}: {red[turns]} {action}")
+                    skipped += 1
                 env.step(action)
             if turns < black_max_turn:
-                wxf_move = black[black.turn == turns]['move'].item()
-                action = env.board.parse_WXF_move(wxf_move)
-                try:
-                    black_moves.append([env.observation, self.build_policy(action, flip=True)])
-                except Exception as e:
-                    for i in range(10):
-                        logger.debug(f"{env.board.screen[i]}")
-                    logger.debug(f"{turns} {wxf_move} {action}")
-                
+                action = env.board.parse_WXF_move(black[turns])
+                if action in Move_2_Idx:
+                    # black moves are learnt from the flipped board
+                    black_moves.append([fenv.state_to_compact(env.observation), int(Unflipped_index[Move_2_Idx[action]])])
+                else:
+                    logger.debug(f"Skip move at turn {turns}: {black[turns]} {action}")
+                    skipped += 1
                 env.step(action)
             turns += 1
-
-        if winner == 'red':
-            red_win = 1
-        elif winner == 'black':
-            red_win = -1
-        else:
-            red_win = 0
-
-        for move in red_moves:
-            move += [red_win]
-        for move in black_moves:
-            move += [-red_win]
-
-        data = []
-        for i in range(len(red_moves)):
-            data.append(red_moves[i])
-            if i < len(black_moves):
-                data.append(black_moves[i])
-        self.buffer += data
-
-    def build_policy(self, action, flip):
-        labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-        policy = np.zeros(labels_n)
-
-        policy[move_lookup[action]] = 1
-
-        if flip:
-            policy = flip_policy(policy)
-        return policy
-
-    def convert_to_trainging_data(self):
-        data = self.buffer
-        state_list = []
-        policy_list = []
-        value_list = []
-        env = CChessEnv()
-
-        for state_fen, policy, value in data:
-            state_planes = env.fen_to_planes(state_fen)
-            sl_value = value
-
-            state_list.append(state_planes)
-            policy_list.append(policy)
-            value_list.append(sl_value)
-
-        return np.asarray(state_list, dtype=np.float32), \
-               np.asarray(policy_list, dtype=np.float32), \
-               np.asarray(value_list, dtype=np.float32)
-
-
-
+    except Exception as e:
+        logger.error(f"Skip game at turn {turns}: {e}")
+        return None
+
+    if winner == 'red':
+        red_win = 1
+    elif winner == 'black':
+        red_win = -1
+    else:
+        red_win = 0
+
+    for move in red_moves:
+        move += [red_win]
+    for move in black_moves:
+        move += [-red_win]
+
+    data = []
+    for i in range(len(red_moves)):
+        data.append(red_moves[i])
+        if i < len(black_moves):
+            data.append(black_moves[i])
+    if not data:
+        return [], [], [], skipped
+    states, policies, values = zip(*data)
+    return list(states), list(policies), list(values), skipped
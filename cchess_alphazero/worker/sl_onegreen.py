@@ -16,7 +16,7 @@ from cchess_alphazero.config import Config
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
 from cchess_alphazero.lib.model_helper import load_sl_best_model_weight, save_as_sl_best_model
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, build_policy, flip_move
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.environment.lookup_tables import Winner
 
@@ -175,15 +175,7 @@ class SupervisedWorker:
         return red_win
 
     def build_policy(self, action, flip):
-        labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-        policy = np.zeros(labels_n)
-
-        policy[move_lookup[action]] = 1
-
-        if flip:
-            policy = flip_policy(policy)
-        return policy
+        return build_policy(action, flip)
 
     def convert_to_trainging_data(self):
         data = self.buffer